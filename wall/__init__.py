@@ -8,19 +8,40 @@ import sys
 import os
 import json
 import exceptions
-from datetime import datetime
+import socket
+import signal
+from copy import copy
+from functools import partial
+from time import time, clock
+from datetime import datetime, timedelta
 from logging import StreamHandler, Formatter, getLogger, DEBUG
 from ConfigParser import SafeConfigParser, Error as ConfigParserError
 from subprocess import Popen
 from string import ascii_lowercase
 from random import choice
-from collections import OrderedDict
-from tornado.ioloop import IOLoop
+from hashlib import sha1
+from calendar import timegm
+from collections import OrderedDict, deque
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.web import Application, RequestHandler, StaticFileHandler
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.platform.auto import set_close_exec
+from tornado.iostream import IOStream, StreamClosedError
 import tornado.autoreload
-from tornado.websocket import WebSocketHandler
-from redis import StrictRedis
-from wall.util import EventTarget, Event, ObjectRedis, RedisContainer, truncate
+from tornado.websocket import WebSocketHandler, WebSocketProtocol13
+from tornado.escape import utf8
+from tornado.gen import coroutine, Return
+from tornado.concurrent import is_future
+from wall.util import (EventTarget, Event, ObjectRedis, RedisContainer,
+    truncate, timestamp, parse_isotime)
+from wall.storage import open_engine
+from wall.search import SearchIndex
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 release = 20
 
@@ -37,7 +58,16 @@ class WallApp(Application, EventTarget):
         self.bricks = {}
         self.post_types = {}
         self.clients = []
+        # client sessions by id
+        self.sessions = {}
+        # subscribers per topic, a set of sessions
+        self.topics = {}
+        # sequence number of the last message sent to all or some clients
+        self._seq = 0
         self.current_post = None
+        # hand over to a new server process in progress (see restart)
+        self._restarting = False
+        self._exit = None
         self._init = True
 
         self._setup_logger()
@@ -60,18 +90,96 @@ class WallApp(Application, EventTarget):
                 self.config[prefix + key] = value
         self.config.update(config)
 
-        self.db = ObjectRedis(StrictRedis(db=int(self.config['db'])),
-            self._decode_redis_hash)
+        storage = self.config['storage']
+        shards = [s.split(',') for s in self.config['redis_shards'].split()]
+        try:
+            r, a = open_engine(storage, db=int(self.config['db']),
+                path=self.config['sqlite_path'], shards=shards)
+        except exceptions.ValueError:
+            self.logger.error('configuration: invalid storage or redis_shards')
+            self._init = False
+            return
+        packed = self.config['post_encoding'] == 'packed'
+        self.db = ObjectRedis(r, self._decode_redis_hash,
+            cache_size=int(self.config['cache_size']),
+            cache_ttl=float(self.config['cache_ttl']), a=a,
+            pack=pack_post if packed else None,
+            unpack=unpack_post if packed else None)
+        # a script cannot access keys distributed across multiple servers
+        self._claim_script = storage == 'redis' and not shards
+        if self.config['cache_notifications'] == 'True':
+            if storage == 'redis' and not shards:
+                self.db.subscribe_notifications()
+                PeriodicCallback(self.db.process_notifications, 100).start()
+            else:
+                self.logger.warning('configuration: cache_notifications requires storage = redis without redis_shards')
         self.posts = RedisContainer(self.db, 'posts')
+        self.history_size = int(self.config['history_size'])
+        self.client_max_requests = int(self.config['client_max_requests'])
+        self.client_max_buffer = int(self.config['client_max_buffer'])
+        self.client_lag_timeout = float(self.config['client_lag_timeout'])
+        self.compression = self.config['compression'] == 'True'
+        self.compression_level = int(self.config['compression_level'])
+        self.compression_min_size = int(self.config['compression_min_size'])
+        self.compression_context_takeover = (
+            self.config['compression_context_takeover'] == 'True')
+        # compression statistics: number of compressed `messages`, their size
+        # in `bytes` before and after (`compressed_bytes`) compression and the
+        # CPU `time` in seconds spent on compression
+        self.compression_stats = {'messages': 0, 'bytes': 0,
+                                  'compressed_bytes': 0, 'time': 0.0}
+        self.heartbeat_timeout = float(self.config['heartbeat_timeout'])
+        self.session_timeout = float(self.config['session_timeout'])
+        self.session_replay_size = int(self.config['session_replay_size'])
+        heartbeat_interval = float(self.config['heartbeat_interval'])
+        self._heartbeat_timer = None
+        if heartbeat_interval > 0:
+            self._heartbeat_timer = PeriodicCallback(self._heartbeat,
+                heartbeat_interval * 1000)
+        # client statistics: number of `connected` clients and of `reaped` dead
+        # connections since start. Live clients are in `clients`.
+        self.client_stats = {'connected': 0, 'reaped': 0}
+        self._history_view = None
+        self._history_msg = None
+        self._history_version = 0
+        # changes whenever posts are removed, which invalidates the cursors of
+        # get_history (see _make_history_delta_msg)
+        self._history_epoch = randstr()
+        self._migrate_history_index()
+
+        self.retention_max_count = int(self.config['retention_max_count'])
+        self.retention_max_age = float(self.config['retention_max_age'])
+        self.retention_type_limits = {}
+        for item in self.config['retention_type_limits'].split():
+            try:
+                post_type, limit = item.split(':')
+                self.retention_type_limits[post_type] = int(limit)
+            except exceptions.ValueError:
+                self.logger.warning('configuration: invalid item in retention_type_limits: "{}"'.format(item))
+        self.compaction_batch_size = int(self.config['compaction_batch_size'])
+        self._compacting = False
+        compaction_interval = float(self.config['compaction_interval'])
+        self._compaction = None
+        if compaction_interval > 0 and (self.retention_max_count or
+            self.retention_max_age or self.retention_type_limits):
+            self._compaction = PeriodicCallback(self._compact,
+                compaction_interval * 1000)
+            self._compaction.start()
 
         self.add_post_type(TextPost)
         self.add_post_type(ImagePost)
         self.msg_handlers = {
             'post': self.post_msg,
             'post_new': self.post_new_msg,
-            'get_history': self.get_history_msg
+            'post_new_batch': self.post_new_batch_msg,
+            'get_history': self.get_history_msg,
+            'search_history': self.search_history_msg,
+            'subscribe': self.subscribe_msg,
+            'unsubscribe': self.unsubscribe_msg
         }
+        self.msg_deliveries = {}
         self.add_event_listener('posted', self._posted)
+        self.add_event_listener('removed', self._removed)
 
         # initialize bricks
         bricks = self.config['bricks'].split()
@@ -80,6 +188,15 @@ class WallApp(Application, EventTarget):
             brick = module.Brick(self)
             self.bricks[brick.id] = brick
 
+        # requires the post types of all bricks
+        self.search_index = SearchIndex()
+        self._build_search_index()
+
+        # the most recently posted post is still shown after a restart
+        ids = self.db.zrevrange('history', 0, 0)
+        if ids:
+            self._restore_current_post(ids[0])
+
         self.do_post_handlers = []
         for handler in self.config['do_post_handlers'].split():
             if handler not in ['note', 'history']:
@@ -129,10 +246,148 @@ class WallApp(Application, EventTarget):
     def run(self):
         if not self._init:
             return
-        self.listen(8080)
+
+        # when started by restart, take over the listening sockets and warm
+        # start from the snapshot before accepting connections
+        fds = os.environ.pop('WALL_LISTEN_FDS', None)
+        if fds:
+            self._sockets = []
+            for item in fds.split(','):
+                fd, family = (int(v) for v in item.split(':'))
+                self._sockets.append(self._adopt_socket(fd, family))
+            self._take_over(self._adopt_socket(
+                int(os.environ.pop('WALL_RESTART_FD')), socket.AF_UNIX))
+        else:
+            self._sockets = bind_sockets(8080)
+        self._server = HTTPServer(self)
+        self._server.add_sockets(self._sockets)
+
+        signal.signal(signal.SIGHUP, lambda signum, frame:
+            IOLoop.current().add_callback_from_signal(self.restart))
+        if self._heartbeat_timer:
+            self._heartbeat_timer.start()
         self.logger.info('server started')
         IOLoop.instance().start()
 
+    def restart(self):
+        """
+        Restart the server without downtime. Triggered by the signal `SIGHUP`.
+
+        A new server process is started, which inherits the listening sockets.
+        This one keeps serving until the new process is ready. Then it stops
+        accepting connections, disconnects the clients and hands over its state
+        (see `snapshot`), from which the new process warm starts. Clients resume
+        their sessions with the new process, while incoming connections wait in
+        the backlog of the listening sockets. If the new process fails to start,
+        this one keeps serving.
+        """
+        if self._restarting:
+            return
+        # the new process signals that it is ready and receives the snapshot
+        # over a socket pair
+        channel, child_channel = socket.socketpair()
+        set_close_exec(channel.fileno())
+        fds = [(os.dup(s.fileno()), s.family) for s in self._sockets]
+        env = dict(os.environ, WALL_RESTART_FD=str(child_channel.fileno()),
+            WALL_LISTEN_FDS=','.join('{}:{}'.format(*fd) for fd in fds))
+        try:
+            process = Popen([sys.executable] + sys.argv, env=env,
+                close_fds=False)
+        except OSError as e:
+            channel.close()
+            self.logger.error('restart failed: %s', e)
+            return
+        finally:
+            child_channel.close()
+            for fd, family in fds:
+                os.close(fd)
+        self._restarting = True
+        self._hand_over(IOStream(channel), process)
+
+    @coroutine
+    def _hand_over(self, channel, process):
+        # hand over to the new server `process` once it is ready
+        try:
+            yield channel.read_bytes(len(b'ready'))
+        except StreamClosedError:
+            process.wait()
+            self.logger.error('restart failed, new server process exited with status %d',
+                process.returncode)
+            self._restarting = False
+            return
+
+        self._server.stop()
+        # messages sent after the snapshot do not reach the clients anymore
+        for client in list(self.clients):
+            client.close(1012, 'restart')
+        yield channel.write(json.dumps(self.snapshot()))
+        channel.close()
+        self.logger.info('restarting, handed over to new server process')
+        # give the clients time to receive the close frames
+        self._exit = IOLoop.current().call_later(1, IOLoop.current().stop)
+
+    def _take_over(self, channel):
+        # counterpart of _hand_over: signal readiness to the old server process
+        # and restore its snapshot
+        channel.setblocking(1)
+        channel.settimeout(60)
+        data = []
+        try:
+            channel.sendall(b'ready')
+            while True:
+                chunk = channel.recv(65536)
+                if not chunk:
+                    break
+                data.append(chunk)
+            self.restore(json.loads(b''.join(data)))
+        except Exception:
+            # serve anyway
+            self.logger.exception('failed to restore snapshot')
+        finally:
+            channel.close()
+
+    def _adopt_socket(self, fd, family):
+        # create a socket from the inherited file descriptor `fd`
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        os.close(fd)
+        set_close_exec(sock.fileno())
+        sock.setblocking(0)
+        return sock
+
+    def snapshot(self):
+        """
+        Return a snapshot of the in-memory state of the server, i.e. the current
+        post, the client sessions and the state of the bricks (see
+        `Brick.snapshot`). The snapshot is a JSON object (a `dict`).
+        """
+        bricks = {}
+        for brick in self.bricks.values():
+            state = brick.snapshot()
+            if state is not None:
+                bricks[brick.id] = state
+        return {
+            'current_post': self.current_post.id if self.current_post else None,
+            'seq': self._seq,
+            'sessions': [s.snapshot() for s in self.sessions.values()],
+            'bricks': bricks
+        }
+
+    def restore(self, snapshot):
+        """
+        Restore the state of the server from a `snapshot` (see `snapshot`).
+        Restored sessions may be resumed within `session_timeout`.
+        """
+        id = snapshot['current_post']
+        if id and not (self.current_post and self.current_post.id == id):
+            self._restore_current_post(id)
+        self._seq = snapshot['seq']
+        for state in snapshot['sessions']:
+            session = Session.restore(self, state)
+            self.sessions[session.id] = session
+        for id, state in snapshot['bricks'].items():
+            if id in self.bricks:
+                self.bricks[id].restore(state)
+
     def add_message_handler(self, type, handler):
         """
         Extension API: register a new message `handler` for messages of the
@@ -142,29 +397,163 @@ class WallApp(Application, EventTarget):
         message. It may return a `Message`, which is sent back to the sender as
         response. If a (subclass of) `Error` is raised, it is converted to a
         `Message` and sent back to the sender as error response.
+
+        A handler may also be asynchronous and return a `Future` for the
+        response (e.g. a coroutine), which is sent when it is resolved. A client
+        may have up to `client_max_requests` asynchronous requests in flight, so
+        responses may arrive out of order. If a request carries an `id`, its
+        response carries the same `id`.
         """
         self.msg_handlers[type] = handler
 
-    def sendall(self, msg):
-        for client in self.clients:
+    def set_message_delivery(self, type, delivery):
+        """
+        Extension API: set the `delivery` of messages of the given `type`, which
+        are sent to clients. It determines what happens to a message while a
+        client is lagging, i.e. more than `client_max_buffer` bytes are waiting
+        to be sent to it:
+
+         * `reliable`: the message is sent anyway (default)
+         * `droppable`: the message is dropped
+         * `replaceable`: the message is held back and replaced by any newer
+           message of the same type. The latest one is sent once the client
+           caught up.
+
+        A client lagging for longer than `client_lag_timeout` is disconnected.
+        """
+        if delivery not in ['reliable', 'droppable', 'replaceable']:
+            raise exceptions.ValueError('delivery')
+        self.msg_deliveries[type] = delivery
+
+    def subscribe(self, client, topic):
+        """
+        Subscribe `client` to `topic`, so that it receives the messages
+        published to the topic. Every client is subscribed to `posted` on
+        connect.
+
+        `client` is a client connection (`Socket`), whose `Session` is
+        subscribed, or a session.
+        """
+        session = client.session if isinstance(client, Socket) else client
+        self.topics.setdefault(topic, set()).add(session)
+        session.topics.add(topic)
+
+    def unsubscribe(self, client, topic):
+        """
+        Unsubscribe `client` from `topic`. If the client is not subscribed,
+        nothing happens. Clients are unsubscribed from all topics when their
+        session ends.
+        """
+        session = client.session if isinstance(client, Socket) else client
+        sessions = self.topics.get(topic)
+        if sessions:
+            sessions.discard(session)
+            if not sessions:
+                del self.topics[topic]
+        session.topics.discard(topic)
+
+    def publish(self, topic, msg):
+        """
+        Send `msg` to all subscribers of `topic`. Like with `sendall`, the
+        message is serialized only once.
+        """
+        sessions = self.topics.get(topic)
+        if sessions:
+            self.sendall(msg, list(sessions))
+
+    def sendall(self, msg, clients=None):
+        """
+        Send `msg` to all clients or, if given, to the list of `clients`
+        (connections or sessions). All clients includes the ones, which are
+        briefly disconnected (see `Session`).
+
+        The message is serialized only once for all recipients and numbered
+        with the next sequence number.
+        """
+        if clients is None:
+            clients = list(self.sessions.values())
+        self._seq += 1
+        msg = PreparedMessage(msg.type, msg.data,
+            data_json=getattr(msg, 'data_json', None), seq=self._seq)
+        for client in clients:
             client.send(msg)
 
+    @coroutine
     def post_msg(self, msg):
         # TODO: error handling
-        post = self.post(msg.data['id'])
-        return Message('post', post.json())
+        post = yield self.post_async(msg.data['id'])
+        raise Return(Message('post', post.json()))
 
+    @coroutine
     def post_new_msg(self, msg):
         # wake display
         Popen('DISPLAY=:0.0 xset dpms force on', shell=True)
 
         post_type = msg.data.pop('type')
-        post = self.post_new(post_type, **msg.data)
-        return Message('post_new', post.json())
+        post = yield self.post_new_async(post_type, **msg.data)
+        raise Return(Message('post_new', post.json()))
 
+    @coroutine
+    def post_new_batch_msg(self, msg):
+        # wake display
+        Popen('DISPLAY=:0.0 xset dpms force on', shell=True)
+
+        posts = yield self.post_new_batch_async(msg.data)
+        raise Return(Message('post_new_batch', [p.json() for p in posts]))
+
+    @coroutine
     def get_history_msg(self, msg):
-        return Message('get_history',
-            [p.json('common') for p in self.get_history()])
+        # served from the materialized history view (see _update_history_view),
+        # which is loaded on the first request. Posts posted by other processes
+        # sharing the database are not reflected.
+        #
+        # Without arguments, the whole history is returned. If a `cursor` is
+        # given, only the posts posted after it are returned (see
+        # _make_history_delta_msg).
+        args = msg.data or {}
+        if 'cursor' in args:
+            cursor = args['cursor']
+            count = args.get('count', self.history_size)
+            if cursor is not None and not isinstance(cursor, basestring):
+                raise ValueError('cursor')
+            if not isinstance(count, (int, long)) or count < 1:
+                raise ValueError('count')
+            response = lambda view: self._make_history_delta_msg(view, cursor,
+                count)
+        else:
+            response = lambda view: (self._history_msg
+                if view is self._history_view else self._make_history_msg(view))
+
+        view = self._history_view
+        if view is None:
+            view = yield self._load_history_view()
+        raise Return(response(view))
+
+    @coroutine
+    def search_history_msg(self, msg):
+        query = msg.data.get('query')
+        count = msg.data.get('count', self.history_size)
+        if not isinstance(query, basestring):
+            raise ValueError('query')
+        if not isinstance(count, (int, long)) or count < 1:
+            raise ValueError('count')
+        posts = yield self.search_history_async(query, count)
+        raise Return(
+            Message('search_history', [p.json('common') for p in posts]))
+
+    def subscribe_msg(self, msg):
+        topic = msg.data.get('topic')
+        if not isinstance(topic, basestring):
+            raise ValueError('topic')
+        self.subscribe(msg.frm, topic)
+        return Message('subscribe')
+
+    def unsubscribe_msg(self, msg):
+        topic = msg.data.get('topic')
+        if not isinstance(topic, basestring):
+            raise ValueError('topic')
+        self.unsubscribe(msg.frm, topic)
+        return Message('unsubscribe')
 
     def post(self, id):
         try:
@@ -172,29 +561,128 @@ class WallApp(Application, EventTarget):
         except KeyError:
             raise ValueError('id_nonexistent')
 
-        if self.current_post:
-            self.current_post.deactivate()
+        pipe = self.db.pipeline()
+        self._queue_posted(pipe, post, datetime.utcnow())
+        pipe.execute()
+        self._update_indexes([post])
+        return self._activate(post)
 
-        self.current_post = post
-        post.posted = datetime.utcnow().isoformat()
-        self.db.hset(post.id, 'posted', post.posted)
-        post.activate()
+    @coroutine
+    def post_async(self, id):
+        """
+        Asynchronous variant of `post`. Returns a `Future` for the post.
+        """
+        try:
+            post = yield self.posts.get_async(id)
+        except KeyError:
+            raise ValueError('id_nonexistent')
 
-        self.dispatch_event(Event('posted', post=post))
-        return post
+        pipe = self.db.a.pipeline()
+        self._queue_posted(pipe, post, datetime.utcnow())
+        yield pipe.execute()
+        self._update_indexes([post])
+        raise Return(self._activate(post))
 
     def post_new(self, type, **args):
-        try:
-            post_type = self.post_types[type]
-        except KeyError:
-            raise ValueError('type_nonexistent')
+        return self.post_new_batch([dict(args, type=type)])[-1]
 
-        post = post_type.create(self, **args)
-        self.db.sadd('posts', post.id)
-        return self.post(post.id)
+    @coroutine
+    def post_new_async(self, type, **args):
+        """
+        Asynchronous variant of `post_new`. Returns a `Future` for the post.
+        """
+        posts = yield self.post_new_batch_async([dict(args, type=type)])
+        raise Return(posts[-1])
 
-    def get_history(self):
-        return sorted(self.posts.values(), key=lambda p: p.posted, reverse=True)
+    def post_new_batch(self, posts):
+        """
+        Create multiple new posts at once and post the last one. `posts` is a
+        list of the arguments for each post, including its `type`. The posts are
+        stored and added to the history in a single transaction. Returns the
+        list of created posts.
+
+        If there already is a post with the same content as a new post (see
+        `Post.content_fields`), the existing post is posted again instead.
+        """
+        posts = self._new_posts(posts)
+        keys = [p.content_key(p.json()) for p in posts]
+        posts, new = self._dedupe(posts, keys, self._lookup_content(keys))
+        pipe = self.db.pipeline()
+        claims = self._queue_new(pipe, posts, keys, new)
+        lost = self._lost_claims(posts, claims, pipe.execute())
+        if lost:
+            existing = self.db.omget(owner for claim, owner in lost)
+            pipe = self.db.pipeline()
+            posts = self._queue_claimed(pipe, posts, lost, existing)
+            pipe.execute()
+        self._update_indexes(posts)
+        self._activate(posts[-1])
+        return posts
+
+    @coroutine
+    def post_new_batch_async(self, posts):
+        """
+        Asynchronous variant of `post_new_batch`. Returns a `Future` for the
+        posts.
+        """
+        posts = self._new_posts(posts)
+        keys = [p.content_key(p.json()) for p in posts]
+        existing = yield self._lookup_content_async(keys)
+        posts, new = self._dedupe(posts, keys, existing)
+        pipe = self.db.a.pipeline()
+        claims = self._queue_new(pipe, posts, keys, new)
+        lost = self._lost_claims(posts, claims, (yield pipe.execute()))
+        if lost:
+            existing = yield self.db.omget_async(owner for claim, owner in lost)
+            pipe = self.db.a.pipeline()
+            posts = self._queue_claimed(pipe, posts, lost, existing)
+            yield pipe.execute()
+        self._update_indexes(posts)
+        self._activate(posts[-1])
+        raise Return(posts)
+
+    def get_history(self, count=None):
+        """
+        Return the `count` most recently posted posts, newest first. If `count`
+        is not given, the whole history is returned.
+
+        The history is read from the `history` index, a sorted set of post ids
+        scored by the time they were last posted.
+        """
+        stop = count - 1 if count is not None else -1
+        return self.db.omget(self.db.zrevrange('history', 0, stop))
+
+    @coroutine
+    def get_history_async(self, count=None):
+        """
+        Asynchronous variant of `get_history`. Returns a `Future` for the posts.
+        """
+        stop = count - 1 if count is not None else -1
+        ids = yield self.db.a.zrevrange('history', 0, stop)
+        posts = yield self.db.omget_async(ids)
+        raise Return(posts)
+
+    def search_history(self, query, count=None):
+        """
+        Search the posts for the words of `query` and return the `count` most
+        recently posted matches, newest first. If `count` is not given, all
+        matches are returned.
+
+        A post matches if every word of the query is a prefix of a word of its
+        text (see `Post.search_fields`). The search index is kept in memory and
+        rebuilt from the database at startup.
+        """
+        return [p for p in self.db.omget(self.search_index.search(query, count))
+                if p]
+
+    @coroutine
+    def search_history_async(self, query, count=None):
+        """
+        Asynchronous variant of `search_history`. Returns a `Future` for the
+        posts.
+        """
+        posts = yield self.db.omget_async(self.search_index.search(query, count))
+        raise Return([p for p in posts if p])
 
     def add_post_type(self, post_type):
         """
@@ -203,6 +691,366 @@ class WallApp(Application, EventTarget):
         """
         self.post_types[post_type.__name__] = post_type
 
+    def _new_posts(self, posts):
+        # create (but do not store) new posts from a list of post arguments
+        if not posts:
+            raise ValueError('posts_empty')
+
+        result = []
+        for args in posts:
+            args = dict(args)
+            try:
+                post_type = self.post_types[args.pop('type', None)]
+            except KeyError:
+                raise ValueError('type_nonexistent')
+            if post_type.create.__func__ is Post.create.__func__:
+                post = post_type.new(self, **args)
+            else:
+                # the post type stores the post itself (blocking)
+                post = post_type.create(self, **args)
+            result.append(post)
+        return result
+
+    def _lookup_content(self, keys):
+        # get the existing posts for the given content keys. Returns a
+        # dictionary, which maps content keys to posts. With Redis, content keys
+        # are claimed by a script instead (see _queue_claim).
+        keys = [k for k in keys if k]
+        if not keys or self._claim_script:
+            return {}
+        found = [(k, id) for k, id in zip(keys, self.db.mget(keys)) if id]
+        posts = self.db.omget(id for k, id in found)
+        return dict((k, p) for (k, id), p in zip(found, posts) if p)
+
+    @coroutine
+    def _lookup_content_async(self, keys):
+        keys = [k for k in keys if k]
+        if not keys or self._claim_script:
+            raise Return({})
+        ids = yield self.db.a.mget(keys)
+        found = [(k, id) for k, id in zip(keys, ids) if id]
+        posts = yield self.db.omget_async(id for k, id in found)
+        raise Return(dict((k, p) for (k, id), p in zip(found, posts) if p))
+
+    def _dedupe(self, posts, keys, existing):
+        # replace new `posts` by `existing` posts with the same content (also
+        # within `posts`). Returns the resulting posts and a list, which tells
+        # for each post if it is new.
+        result = []
+        new = []
+        for post, key in zip(posts, keys):
+            if key and key in existing:
+                result.append(existing[key])
+                new.append(False)
+            else:
+                result.append(post)
+                new.append(True)
+                if key:
+                    existing[key] = post
+        return result, new
+
+    def _queue_new(self, pipe, posts, keys, new):
+        # queue the commands for storing the `posts` which are `new` and posting
+        # all `posts` on `pipe`. Consecutive posts are posted a microsecond
+        # apart, to keep their order in the history.
+        #
+        # With Redis, posts with a content key are claimed, stored and posted
+        # by a script, queued first (see _queue_claim). Returns the list of
+        # claims, tuples of the position of the post and the time it is posted.
+        now = datetime.utcnow()
+        claims = []
+        for i, (post, key, is_new) in enumerate(zip(posts, keys, new)):
+            posted = now + timedelta(microseconds=i)
+            if key and self._claim_script:
+                self._queue_claim(pipe, post, key, posted)
+                claims.append((i, posted))
+        for i, (post, key, is_new) in enumerate(zip(posts, keys, new)):
+            if key and self._claim_script:
+                continue
+            if is_new:
+                self.db.store(post.id, post.json(), pipe)
+                pipe.sadd('posts', post.id)
+                if key:
+                    pipe.set(key, post.id)
+            self._queue_posted(pipe, post, now + timedelta(microseconds=i))
+        return claims
+
+    def _queue_claim(self, pipe, post, key, posted):
+        # queue the script which claims the content `key` for `post`, and if
+        # successful stores and posts it at the time `posted`, on `pipe` (see
+        # _CLAIM_SCRIPT). Thus, concurrent posts with the same content do not
+        # both create a post.
+        post.posted = posted.isoformat()
+        hash = post.json()
+        self.db.invalidate(post.id)
+        if self.db.pack:
+            data = ['packed', self.db.pack(post.id, hash)]
+        else:
+            data = ['hash'] + [v for item in hash.items() for v in item]
+        pipe.eval(_CLAIM_SCRIPT, 5, key, post.id, 'posts', 'history',
+            'history:' + type(post).__name__, timestamp(posted), *data)
+
+    def _lost_claims(self, posts, claims, replies):
+        # the claims of `posts` lost to existing posts, together with the id of
+        # the owner
+        return [(claim, owner) for claim, owner in zip(claims, replies)
+                if owner != posts[claim[0]].id]
+
+    def _queue_claimed(self, pipe, posts, lost, existing):
+        # queue the commands for posting the `existing` posts, which own the
+        # content of the `posts` that `lost` their claims, on `pipe`. Returns
+        # the resulting posts.
+        posts = list(posts)
+        for ((i, posted), owner), post in zip(lost, existing):
+            if not post:
+                # removed in the meantime, so the new post is stored after all
+                post = posts[i]
+                self.db.store(post.id, post.json(), pipe)
+                pipe.sadd('posts', post.id)
+                pipe.set(post.content_key(post.json()), post.id)
+            elif type(posts[i]).create.__func__ is not Post.create.__func__:
+                # the post type stored the lost post itself
+                pipe.delete(posts[i].id)
+            posts[i] = post
+            self._queue_posted(pipe, post, posted)
+        return posts
+
+    def _queue_posted(self, pipe, post, posted):
+        # queue the commands for posting `post` at the time `posted` on `pipe`
+        post.posted = posted.isoformat()
+        if self.db.pack:
+            self.db.store(post.id, post.json(), pipe)
+        else:
+            pipe.hset(post.id, 'posted', post.posted)
+        pipe.zadd('history', timestamp(posted), post.id)
+        pipe.zadd('history:' + type(post).__name__, timestamp(posted), post.id)
+
+    def _update_indexes(self, posts):
+        # update the history view and the search index for the just posted
+        # `posts`
+        self._update_history_view(posts)
+        for post in posts:
+            self._index_post(post.id, post.json())
+
+    def _index_post(self, id, fields):
+        document = self._search_document(id, fields)
+        if document:
+            self.search_index.add(*document)
+
+    def _search_document(self, id, fields):
+        # (id, text, key) of the post with the hash fields for the search index
+        post_type = self.post_types.get(fields.get('__type__'))
+        if not post_type:
+            return None
+        posted = fields.get('posted')
+        key = (timestamp(parse_isotime(posted))
+               if posted and posted != 'None' else 0)
+        return (id, post_type.search_text(fields), key)
+
+    def _build_search_index(self):
+        self.search_index.add_all(
+            d for d in (self._search_document(id, hash)
+                        for id, hash in self._load_all_posts()) if d)
+
+    def _load_all_posts(self):
+        # generate (id, hash) of all posts, loaded in batches
+        ids = list(self.db.smembers('posts'))
+        batch_size = 1000
+        for i in xrange(0, len(ids), batch_size):
+            batch = ids[i:i + batch_size]
+            for id, hash in zip(batch, self.db.mload(batch)):
+                if hash:
+                    yield id, hash
+
+    def _update_history_view(self, posts):
+        # move the just posted `posts` (oldest first) to the front of the
+        # materialized history view, which holds the common view of the newest
+        # posts and the prepared get_history message
+        self._history_version += 1
+        if self._history_view is None:
+            return
+        ids = set()
+        view = []
+        for post in reversed(posts):
+            if post.id not in ids:
+                ids.add(post.id)
+                view.append(self._history_item(post))
+        view.extend(item for item in self._history_view if item[0] not in ids)
+        self._history_view = view[:self.history_size]
+        self._history_msg = self._make_history_msg(self._history_view)
+
+    def _history_item(self, post):
+        return post.id, post.json('common'), post.json_str('common')
+
+    @coroutine
+    def _load_history_view(self):
+        version = self._history_version
+        posts = yield self.get_history_async(self.history_size)
+        view = [self._history_item(p) for p in posts]
+        # if posted while loading, the view is already outdated
+        if version == self._history_version:
+            self._history_view = view
+            self._history_msg = self._make_history_msg(view)
+        raise Return(view)
+
+    def _make_history_msg(self, view):
+        return PreparedMessage('get_history', [data for id, data, s in view],
+            data_json='[' + ', '.join(s for id, data, s in view) + ']')
+
+    def _make_history_delta_msg(self, view, cursor, count):
+        # respond with the posts of the history `view` posted after `cursor`
+        # (`None` or `<epoch>:<posted>`, with the posted time of the newest post
+        # known to the client), newest first. If there are more than `count`
+        # posts, the oldest ones are returned and `more` is set. The new
+        # `cursor` is the one of the newest returned post.
+        #
+        # If posts were removed since the cursor was issued (the epoch changed)
+        # or if the view does not reach back to the cursor, the client cannot
+        # be updated incrementally. Then `reset` is set and the posts are
+        # returned as for a `None` cursor.
+        posted = None
+        reset = False
+        if cursor is not None:
+            epoch, _, posted = cursor.partition(':')
+            if (epoch != self._history_epoch or
+                    (len(view) >= self.history_size and
+                     posted < view[-1][1]['posted'])):
+                posted = None
+                reset = True
+        items = [item for item in view
+                 if posted is None or item[1]['posted'] > posted]
+        more = len(items) > count
+        items = items[-count:]
+        if items:
+            posted = items[0][1]['posted']
+        cursor = ('{}:{}'.format(self._history_epoch, posted)
+                  if posted is not None else None)
+        data = OrderedDict([('posts', [data for id, data, s in items]),
+            ('cursor', cursor), ('more', more), ('reset', reset)])
+        return PreparedMessage('get_history', data, data_json=
+            '{{"posts": [{}], "cursor": {}, "more": {}, "reset": {}}}'.format(
+                ', '.join(s for id, data, s in items), json.dumps(cursor),
+                json.dumps(more), json.dumps(reset)))
+
+    def _activate(self, post):
+        if self.current_post:
+            self.current_post.deactivate()
+
+        self.current_post = post
+        post.activate()
+
+        self.dispatch_event(Event('posted', post=post))
+        return post
+
+    def _restore_current_post(self, id):
+        # show the post `id` again, without announcing it, e.g. after a restart
+        try:
+            post = self.posts[id]
+        except KeyError:
+            self.logger.warning('failed to restore current post %s', id)
+            return
+        if self.current_post:
+            self.current_post.deactivate()
+        self.current_post = post
+        post.activate()
+
+    def _heartbeat(self):
+        # ping all clients and reap the ones, which did not respond in time
+        reaped = 0
+        for client in list(self.clients):
+            if not client.heartbeat():
+                reaped += 1
+        if reaped:
+            self.client_stats['reaped'] += reaped
+            self.logger.info('reaped %d dead client(s), %d live', reaped,
+                len(self.clients) - reaped)
+
+    @coroutine
+    def _compact(self):
+        # remove a batch of posts exceeding the retention limits. The current
+        # post is never removed.
+        if self._compacting:
+            return
+        self._compacting = True
+        try:
+            limits = self.retention_type_limits.items()
+            pipe = self.db.a.pipeline(transaction=False)
+            pipe.zcard('history')
+            for post_type, limit in limits:
+                pipe.zcard('history:' + post_type)
+            counts = yield pipe.execute()
+
+            # every range is scanned one entry further, to skip the current
+            # post if it is among them
+            batch_size = self.compaction_batch_size
+            sizes = []
+            pipe = self.db.a.pipeline(transaction=False)
+            excess = counts[0] - self.retention_max_count
+            if self.retention_max_count and excess > 0:
+                sizes.append(min(excess, batch_size))
+                pipe.zrange('history', 0, sizes[-1])
+            if self.retention_max_age:
+                expired = datetime.utcnow() - timedelta(
+                    days=self.retention_max_age)
+                sizes.append(batch_size)
+                pipe.zrangebyscore('history', '-inf', timestamp(expired), 0,
+                    batch_size + 1)
+            for (post_type, limit), count in zip(limits, counts[1:]):
+                if count > limit:
+                    sizes.append(min(count - limit, batch_size))
+                    pipe.zrange('history:' + post_type, 0, sizes[-1])
+            ranges = yield pipe.execute()
+
+            current = self.current_post.id if self.current_post else None
+            ids = []
+            for r, size in zip(ranges, sizes):
+                for id in [id for id in r if id != current][:size]:
+                    if id not in ids:
+                        ids.append(id)
+            ids = ids[:batch_size]
+            if ids:
+                yield self._remove_posts_async(ids)
+                self.logger.info('removed %d expired post(s)', len(ids))
+        finally:
+            self._compacting = False
+
+    @coroutine
+    def _remove_posts_async(self, ids):
+        hashes = yield self.db.mload_async(ids)
+
+        pipe = self.db.a.pipeline()
+        for id, hash in zip(ids, hashes):
+            self.db.invalidate(id)
+            pipe.delete(id)
+            pipe.srem('posts', id)
+            pipe.zrem('history', id)
+            post_type = hash.get('__type__')
+            if post_type:
+                pipe.zrem('history:' + post_type, id)
+            if post_type in self.post_types:
+                key = self.post_types[post_type].content_key(hash)
+                if key:
+                    # the key may be claimed by another post meanwhile
+                    pipe.delifeq(key, id)
+        yield pipe.execute()
+        self.dispatch_event(Event('removed', ids=ids))
+
+    def _migrate_history_index(self):
+        # one-time migration (Wall < 21): build the history index (and the
+        # history index per post type) from the posts set and the posted time
+        # of each post
+        if self.db.exists('history'):
+            return
+        ids = list(self.db.smembers('posts'))
+        pipe = self.db.pipeline()
+        for id, hash in zip(ids, self.db.mload(ids)):
+            posted = hash.get('posted')
+            if posted and posted != 'None':
+                posted = timestamp(parse_isotime(posted))
+                pipe.zadd('history', posted, id)
+                pipe.zadd('history:' + hash['__type__'], posted, id)
+        pipe.execute()
+
     def _decode_redis_hash(self, hash):
         post_type = self.post_types[hash['__type__']]
         return post_type(self, **hash)
@@ -215,63 +1063,472 @@ class WallApp(Application, EventTarget):
             Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
         logger.addHandler(handler)
 
+    def _removed(self, event):
+        for id in event.args['ids']:
+            self.search_index.remove(id)
+
+        # removed posts leave a gap in the history view, which is rebuilt on
+        # the next request
+        self._history_version += 1
+        self._history_epoch = randstr()
+        if self._history_view and any(
+            item[0] in event.args['ids'] for item in self._history_view):
+            self._history_view = None
+            self._history_msg = None
+
     def _posted(self, event):
-        self.sendall(Message('posted', {'post': event.args['post'].json()}))
+        post = event.args['post']
+        self.publish('posted', PreparedMessage('posted', {'post': post.json()},
+            data_json='{{"post": {}}}'.format(post.json_str())))
 
 class Socket(WebSocketHandler):
     def initialize(self):
         self.app = self.application
+        self._requests = 0
+        self.session = None
+        # last time the client was heard of
+        self._last_seen = time()
+        # number of bytes waiting to be sent
+        self._buffered = 0
+        self._lagging_since = None
+        self._held_msgs = OrderedDict()
+        # messages queued during the current IOLoop iteration, which are sent
+        # together as one frame if the client supports batches
+        self._queue = []
+        self.batch = False
+        self.encoding = 'json'
 
     def send(self, msg):
-        self.write_message(str(msg))
-        self.app.logger.debug('sent message %s to %s', truncate(str(msg)),
+        if self._buffered > self.app.client_max_buffer:
+            now = time()
+            if self._lagging_since is None:
+                self._lagging_since = now
+            elif now - self._lagging_since >= self.app.client_lag_timeout:
+                self.app.logger.warning('client %s lagging, disconnecting',
+                    self.request.remote_ip)
+                self.close()
+                return
+
+            delivery = self.app.msg_deliveries.get(msg.type, 'reliable')
+            if delivery == 'droppable':
+                return
+            elif delivery == 'replaceable':
+                self._held_msgs[msg.type] = msg
+                return
+        self._write(msg)
+
+    def _write(self, msg):
+        if self.encoding == 'msgpack':
+            frame = msg.pack()
+            logged = msg.type
+        else:
+            frame = logged = str(msg)
+        self._buffered += len(frame)
+        if not self._queue:
+            IOLoop.current().add_callback(self._flush)
+        self._queue.append(frame)
+        self.app.logger.debug('sent message %s to %s', truncate(logged),
             self.request.remote_ip)
 
+    def _flush(self):
+        queue = self._queue
+        self._queue = []
+        if not self.ws_connection:
+            # closed in the meantime
+            return
+        binary = self.encoding == 'msgpack'
+        # frames with the size of the messages they hold, as counted by _write
+        if self.batch and len(queue) > 1:
+            size = sum(len(frame) for frame in queue)
+            if binary:
+                frames = [(msgpack.Packer().pack_array_header(len(queue)) +
+                           b''.join(queue), size)]
+            else:
+                frames = [(b'[' + b', '.join(queue) + b']', size)]
+        else:
+            frames = [(frame, len(frame)) for frame in queue]
+        for frame, size in frames:
+            self.write_message(frame, binary=binary).add_done_callback(
+                partial(self._written, size))
+
+    def _written(self, size, future):
+        self._buffered -= size
+        # send held back messages once the client caught up
+        while self._buffered <= self.app.client_max_buffer:
+            self._lagging_since = None
+            if not self._held_msgs:
+                break
+            self._write(self._held_msgs.popitem(last=False)[1])
+
+    def get_compression_options(self):
+        if not self.app.compression:
+            return None
+        return {'compression_level': self.app.compression_level}
+
+    def get_websocket_protocol(self):
+        version = self.request.headers.get('Sec-WebSocket-Version')
+        if version in ['7', '8', '13']:
+            return CompressingProtocol(self,
+                compression_options=self.get_compression_options())
+
+    def select_subprotocol(self, subprotocols):
+        # the subprotocol selects the encoding of messages
+        if 'msgpack' in subprotocols and msgpack:
+            self.encoding = 'msgpack'
+            return 'msgpack'
+        elif 'json' in subprotocols:
+            return 'json'
+        return None
+
+    @property
+    def topics(self):
+        """Topics the client is subscribed to."""
+        return self.session.topics
+
     def open(self):
+        self.batch = self.get_argument('batch', None) == '1'
         self.app.clients.append(self)
+        self.app.client_stats['connected'] += 1
+
+        # resume the given session, if the client missed no messages which are
+        # lost meanwhile
+        missed = None
+        session = self.app.sessions.get(self.get_argument('session', None))
+        seq = self.get_argument('seq', '')
+        if session and seq.isdigit():
+            missed = session.resume(self, int(seq))
+        if missed is None:
+            session = Session(self.app)
+            self.app.sessions[session.id] = session
+            session.attach(self)
+        self.session = session
+        if missed is None:
+            self.app.subscribe(self, 'posted')
+
         self.app.logger.debug('client %s connected', self.request.remote_ip)
         self.app.dispatch_event(Event('connected', client=self))
 
+        self.send(Message('session',
+            {'id': session.id, 'resumed': missed is not None}))
+        if missed is not None:
+            for msg in missed:
+                self.send(msg)
         # TODO: announce current post as response to hello message
-        if self.app.current_post:
+        elif self.app.current_post:
             self.send(Message('posted', {'post': self.app.current_post.json()}))
 
     def on_close(self):
         self.app.clients.remove(self)
+        # the session may have been taken over by a new connection already
+        if self.session.socket is self:
+            self.session.detach()
         self.app.logger.debug('client %s disconnected', self.request.remote_ip)
         self.app.dispatch_event(Event('disconnected', client=self))
 
+    def heartbeat(self):
+        """
+        Ping the client. If the client did not respond to the previous ping or
+        send anything else within `heartbeat_timeout`, the connection is
+        considered dead and closed instead. Returns `False` in this case,
+        `True` otherwise.
+        """
+        if not self.ws_connection:
+            # closing already, the connection is removed with on_close
+            return True
+        if time() - self._last_seen > self.app.heartbeat_timeout:
+            self.app.logger.debug('client %s not responding, closing',
+                self.request.remote_ip)
+            # the client would not answer a close handshake either
+            self.stream.close()
+            return False
+        self.ping(b'')
+        return True
+
+    def on_pong(self, data):
+        self._last_seen = time()
+
     def on_message(self, msgstr):
-        msg = Message.parse(msgstr, self)
+        self._last_seen = time()
+        try:
+            msg = Message.parse(msgstr, self)
+        except exceptions.ValueError:
+            self.app.logger.warning('client %s sent unsupported message, disconnecting',
+                self.request.remote_ip)
+            self.close(1003)
+            return
         self.app.logger.debug('received message %s from %s', truncate(str(msg)),
             self.request.remote_ip)
 
+        if self._requests >= self.app.client_max_requests:
+            self._respond(msg,
+                Message(msg.type, Error('too_many_requests').json()))
+            return
+
         handle = self.app.msg_handlers[msg.type]
         try:
-            # TODO: support Future for asynchronous handlers (see
-            # https://code.google.com/p/pythonfutures/ )
             response = handle(msg)
         except Error as e:
             response = Message(msg.type, e.json())
 
+        if is_future(response):
+            self._requests += 1
+            if response.done():
+                self._handled(msg, response)
+            else:
+                IOLoop.current().add_future(response,
+                    partial(self._handled, msg))
+        elif response:
+            self._respond(msg, response)
+
+    def _handled(self, msg, future):
+        self._requests -= 1
+        try:
+            response = future.result()
+        except Error as e:
+            response = Message(msg.type, e.json())
+        except Exception:
+            self.app.logger.exception('failed to handle message %s',
+                truncate(str(msg)))
+            response = Message(msg.type, Error('internal').json())
         if response:
-            msg.frm.send(response)
+            self._respond(msg, response)
+
+    def _respond(self, msg, response):
+        # send the response to the request msg, with the same request id
+        if not self.ws_connection:
+            # closed while the request was handled
+            return
+        if msg.id is not None:
+            response = copy(response)
+            response.id = msg.id
+        self.send(response)
+
+class CompressingProtocol(WebSocketProtocol13):
+    """
+    WebSocket protocol, which applies the compression options of the app to
+    the permessage-deflate extension, if negotiated with the client.
+
+    Messages smaller than `compression_min_size` are sent uncompressed. If
+    `compression_context_takeover` is off, every message is compressed on its
+    own. Statistics are collected in `compression_stats`.
+    """
+
+    def _create_compressors(self, side, agreed_parameters,
+                            compression_options=None):
+        if not self.handler.app.compression_context_takeover:
+            # the parameters are included in the response to the client
+            agreed_parameters['server_no_context_takeover'] = None
+        super(CompressingProtocol, self)._create_compressors(side,
+            agreed_parameters, compression_options)
+
+    def write_message(self, message, binary=False):
+        message = utf8(message)
+        app = self.handler.app
+        if not self._compressor or len(message) < app.compression_min_size:
+            self._message_bytes_out += len(message)
+            return self._write_frame(True, 0x2 if binary else 0x1, message)
+
+        t = clock()
+        compressed = self._compressor.compress(message)
+        app.compression_stats['time'] += clock() - t
+        app.compression_stats['messages'] += 1
+        app.compression_stats['bytes'] += len(message)
+        app.compression_stats['compressed_bytes'] += len(compressed)
+        self._message_bytes_out += len(message)
+        return self._write_frame(True, 0x2 if binary else 0x1, compressed,
+            flags=self.RSV1)
+
+class Session(object):
+    """
+    Client session, which survives a brief disconnect of the client.
+
+    Messages sent to all or some clients are numbered with a sequence number
+    (`Message.seq`) and the most recent `session_replay_size` reliable ones (see
+    `WallApp.set_message_delivery`) are kept. A client reconnecting within
+    `session_timeout` may resume its session by passing its `id` and the last
+    sequence number it received, and receives the messages it missed. Topic
+    subscriptions are part of the session.
+
+    Attributes:
+
+     * `id`: session ID.
+     * `app`: Wall application.
+     * `socket`: connection of the client, `None` while it is disconnected.
+     * `topics`: topics the session is subscribed to.
+    """
+
+    def __init__(self, app):
+        self.id = randstr(16)
+        self.app = app
+        self.socket = None
+        self.topics = set()
+        self._replay = deque()
+        # sequence number of the newest message, which cannot be replayed
+        self._lost_seq = 0
+        self._expiry = None
+
+    def send(self, msg):
+        """
+        Send `msg` to the client, or keep it for replay while the client is
+        disconnected.
+        """
+        if (msg.seq is not None and
+            self.app.msg_deliveries.get(msg.type, 'reliable') == 'reliable'):
+            self._replay.append(msg)
+            if len(self._replay) > self.app.session_replay_size:
+                self._lost_seq = self._replay.popleft().seq
+        if self.socket:
+            self.socket.send(msg)
+
+    def attach(self, socket):
+        """
+        Attach the client connection `socket` to the session.
+        """
+        if self._expiry:
+            IOLoop.current().remove_timeout(self._expiry)
+            self._expiry = None
+        self.socket = socket
+
+    def detach(self):
+        """
+        Detach the client connection from the session, which ends after
+        `session_timeout`, unless it is resumed.
+        """
+        self.socket = None
+        self._expiry = IOLoop.current().call_later(self.app.session_timeout,
+            self.end)
+
+    def snapshot(self):
+        """
+        Return a snapshot of the session, a JSON object (see
+        `WallApp.snapshot`).
+        """
+        return {
+            'id': self.id,
+            'topics': list(self.topics),
+            'replay': [{'type': m.type, 'data': m.data, 'seq': m.seq}
+                       for m in self._replay],
+            'lost_seq': self._lost_seq
+        }
+
+    @classmethod
+    def restore(cls, app, state):
+        """
+        Restore a session of the Wall `app` from the snapshot `state`. The
+        session is detached until it is resumed.
+        """
+        session = cls(app)
+        session.id = state['id']
+        for topic in state['topics']:
+            app.subscribe(session, topic)
+        session._replay.extend(
+            PreparedMessage(m['type'], m['data'], seq=m['seq'])
+            for m in state['replay'])
+        session._lost_seq = state['lost_seq']
+        session.detach()
+        return session
+
+    def resume(self, socket, seq):
+        """
+        Resume the session with the new client connection `socket`. `seq` is the
+        sequence number of the last message the client received. A connection
+        still attached to the session is closed.
+
+        Returns the list of messages the client missed. If some of them are not
+        kept anymore, the session cannot be resumed and `None` is returned.
+        """
+        if seq < self._lost_seq:
+            return None
+        if self.socket:
+            # take over from the old connection, which may not be detected as
+            # dead yet, e.g. after a network outage of the client
+            old, self.socket = self.socket, None
+            old.close()
+        self.attach(socket)
+        return [msg for msg in self._replay if msg.seq > seq]
+
+    def end(self):
+        """
+        End the session.
+        """
+        for topic in list(self.topics):
+            self.app.unsubscribe(self, topic)
+        self.app.sessions.pop(self.id, None)
 
 class Message(object):
     @classmethod
     def parse(cls, msgstr, frm=None):
-        msg = json.loads(msgstr)
-        return Message(msg['type'], msg['data'], frm)
+        """
+        Parse a message from `msgstr`, which is JSON text (`unicode`) or
+        MessagePack data (`bytes`). If `msgstr` cannot be decoded, a `ValueError`
+        is raised.
+        """
+        if isinstance(msgstr, bytes):
+            if not msgpack:
+                raise ValueError('msgstr')
+            msg = msgpack.unpackb(msgstr, raw=False)
+        else:
+            msg = json.loads(msgstr)
+        return Message(msg['type'], msg['data'], frm, msg.get('id'))
 
-    def __init__(self, type, data=None, frm=None):
+    def __init__(self, type, data=None, frm=None, id=None, seq=None):
         self.type = type
         self.data = data
         self.frm  = frm
+        self.id   = id
+        self.seq  = seq
 
     def __str__(self):
-        return json.dumps(
-            OrderedDict([('type', self.type), ('data', self.data)])
-        )
+        return json.dumps(self._dict())
+
+    def pack(self):
+        """
+        Encode the message with MessagePack. Requires the `msgpack` package.
+        """
+        return msgpack.packb(self._dict(), use_bin_type=False)
+
+    def _dict(self):
+        msg = OrderedDict([('type', self.type), ('data', self.data)])
+        if self.seq is not None:
+            msg['seq'] = self.seq
+        if self.id is not None:
+            msg['id'] = self.id
+        return msg
+
+class PreparedMessage(Message):
+    """
+    Message, which is serialized once in advance, so that it can be sent
+    repeatedly at no extra cost. The serialized `data` may be given as
+    `data_json`. `data` must not be modified.
+    """
+
+    def __init__(self, type, data=None, frm=None, data_json=None, seq=None):
+        super(PreparedMessage, self).__init__(type, data, frm, seq=seq)
+        if data_json is None:
+            data_json = json.dumps(data)
+        self.data_json = data_json
+        # keep the encoded form (JSON is pure ASCII), which is written to the
+        # socket as is
+        self._str = str('{{"type": {}, "data": {}{}}}'.format(json.dumps(type),
+            data_json, ', "seq": {}'.format(seq) if seq is not None else ''))
+        self._packed = None
+
+    def __str__(self):
+        if self.id is None:
+            return self._str
+        return '{}, "id": {}}}'.format(self._str[:-1], json.dumps(self.id))
+
+    def pack(self):
+        if self._packed is None:
+            id, self.id = self.id, None
+            self._packed = super(PreparedMessage, self).pack()
+            self.id = id
+        if self.id is None:
+            return self._packed
+        # extend the map (with a fixmap header) by the id
+        return (chr(ord(self._packed[0]) + 1) + self._packed[1:] +
+                msgpack.packb('id', use_bin_type=False) +
+                msgpack.packb(self.id, use_bin_type=False))
 
 class ClientPage(RequestHandler):
     def get(self):
@@ -287,24 +1544,118 @@ class DisplayPostPage(RequestHandler):
         self.render('display-post.html', app=self.application)
 
 class Post(object):
+    """
+    Post on the wall.
+
+    The fields of a post type are declared as `__slots__`, which are added to
+    the slots of its base class. Public slots are fields, which are included in
+    the default view (see `json`), whereas slots starting with an underscore
+    hold internal state. For subclasses without `__slots__`, all public instance
+    attributes are fields.
+
+    Static attributes:
+
+     * content_fields: attributes, which make up the content of a post. If set,
+       a new post with the same content as an existing one is not stored, but
+       the existing post is posted again. Defaults to `None`, i.e. posts are
+       not deduplicated.
+     * search_fields: attributes, which make up the text of a post for the
+       history search. Defaults to `['title']`.
+    """
+    __slots__ = ['app', 'id', 'title', 'posted', '_views', '__weakref__']
+    content_fields = None
+    search_fields = ['title']
+
+    @classmethod
+    def new(cls, app, **args):
+        """
+        Extension API: create a new post of this type without storing it. Must
+        be overridden (unless `create` is overridden instead) and return the
+        post. Specific arguments are passed to `new` as `args`. `app` is the
+        wall instance.
+        """
+        raise NotImplementedError()
+
     @classmethod
     def create(cls, app, **args):
         """
-        Extension API: create a post of this type. Must be overridden and create
-        a post, store it in the database and return it. Specific arguments are
-        passed to `create` as `args`. `app` is the wall instance.
+        Extension API: create a post of this type, store it in the database and
+        return it. Specific arguments are passed to `create` as `args`. `app` is
+        the wall instance.
+
+        By default, the post returned by `new` is stored. May be overridden
+        instead of `new`, in which case it is called when a new post of this
+        type should be created via `Wall.post_new` (or one of its variants).
+        Note that such posts are stored blocking, in a separate round trip.
+        """
+        post = cls.new(app, **args)
+        app.db.store(post.id, post.json())
+        return post
 
-        Called when a new post of this type should be created via
-        `Wall.post_new`.
+    @classmethod
+    @coroutine
+    def create_async(cls, app, **args):
         """
-        raise NotImplementedError()
+        Asynchronous variant of `create`. Returns a `Future` for the post.
+        """
+        if cls.create.__func__ is not Post.create.__func__:
+            raise Return(cls.create(app, **args))
+
+        post = cls.new(app, **args)
+        pipe = app.db.a.pipeline()
+        app.db.store(post.id, post.json(), pipe)
+        yield pipe.execute()
+        raise Return(post)
 
     def __init__(self, app, id, title, posted, **kwargs):
+        self._views = None
         self.app = app
         self.id = id
         self.title = title
         self.posted = posted
 
+    @classmethod
+    def fields(cls):
+        """
+        Return the names of the fields declared by this post type (see
+        `Post`).
+        """
+        # computed once per class
+        fields = cls.__dict__.get('_fields')
+        if fields is None:
+            fields = []
+            for c in reversed(cls.__mro__):
+                fields.extend(s for s in c.__dict__.get('__slots__', [])
+                    if not s.startswith('_') and s != 'app')
+            cls._fields = fields
+        return fields
+
+    @classmethod
+    def content_key(cls, fields):
+        """
+        Return the database key identifying the content of a post of this type
+        with the given `fields` (a `dict`), or `None` if posts of this type are
+        not deduplicated.
+        """
+        if not cls.content_fields:
+            return None
+        content = '\0'.join([cls.__name__] +
+            [unicode(fields[f]) for f in cls.content_fields])
+        return 'content:' + sha1(content.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def search_text(cls, fields):
+        """
+        Return the text of a post of this type with the given `fields` (a
+        `dict`) for the history search.
+        """
+        text = []
+        for field in cls.search_fields:
+            value = fields.get(field) or ''
+            text.append(value.decode('utf-8') if isinstance(value, bytes)
+                else unicode(value))
+        return '\n'.join(text)
+
     def activate(self):
         """
         Activate the post.
@@ -324,15 +1675,56 @@ class Post(object):
         pass
 
     def json(self, view=None):
-        if not view:
-            filter = lambda k: not k.startswith('_') and k != 'app'
-        elif view == 'common':
-            filter = lambda k: k in ['id', 'title', 'posted']
-        else:
-            raise ValueError('view')
+        """
+        Return the given `view` of the post as JSON object (a `dict`). The
+        default view holds all fields, the `common` view only `id`, `title` and
+        `posted`.
 
-        return dict(((k, v) for k, v in vars(self).items() if filter(k)),
-            __type__=type(self).__name__)
+        Each view is built once and cached until a field is set again, thus the
+        returned object must not be modified.
+        """
+        return self._view(view)
+
+    def json_str(self, view=None):
+        """
+        Return the given `view` of the post (see `json`) serialized as JSON
+        string. Cached like `json`.
+        """
+        # serialize the result of json, which may be overridden by subclasses
+        key = ('str', view or None)
+        if self._views is None:
+            self._views = {}
+        cached = self._views.get(key)
+        if cached is None:
+            cached = self._views[key] = json.dumps(self.json(view))
+        return cached
+
+    def _view(self, view):
+        view = view or None
+        if self._views is None:
+            self._views = {}
+        cached = self._views.get(view)
+        if cached is None:
+            if not view:
+                fields = self.fields()
+                if hasattr(self, '__dict__'):
+                    # subclass without __slots__
+                    fields = fields + [k for k in vars(self)
+                                       if not k.startswith('_')]
+            elif view == 'common':
+                fields = ['id', 'title', 'posted']
+            else:
+                raise ValueError('view')
+            data = dict(((f, getattr(self, f)) for f in fields),
+                __type__=type(self).__name__)
+            cached = self._views[view] = data
+        return cached
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if not name.startswith('_'):
+            # invalidate cached views
+            object.__setattr__(self, '_views', None)
 
     def __eq__(self, other):
         # TODO: replace this by identity mapping / caching (see
@@ -385,9 +1777,31 @@ class Brick(object):
             else:
                 self.stylesheets = []
 
+    def snapshot(self):
+        """
+        Return a snapshot of the in-memory state of the brick, which is restored
+        after a restart (see `WallApp.restart`), or `None` if there is nothing
+        to keep. The snapshot must be JSON serializable.
+
+        Extension API: may be overridden by bricks with state.
+        """
+        return None
+
+    def restore(self, state):
+        """
+        Restore the in-memory state of the brick from the snapshot `state`.
+
+        Extension API: may be overridden by bricks with state.
+        """
+        pass
+
 class TextPost(Post):
+    __slots__ = ['content']
+    content_fields = ['content']
+    search_fields = ['title', 'content']
+
     @classmethod
-    def create(cls, app, **kwargs):
+    def new(cls, app, **kwargs):
         try:
             content = kwargs['content'].strip()
         except KeyError:
@@ -397,22 +1811,22 @@ class TextPost(Post):
 
         title = truncate(content.splitlines()[0])
 
-        post = TextPost(app, 'text_post:' + randstr(), title, None, content)
-        app.db.hmset(post.id, post.json())
-        return post
+        return TextPost(app, 'text_post:' + randstr(), title, None, content)
 
     def __init__(self, app, id, title, posted, content, **kwargs):
         super(TextPost, self).__init__(app, id, title, posted, **kwargs)
         self.content = content
 
 class ImagePost(Post):
+    __slots__ = ['url']
+    content_fields = ['url']
+    search_fields = ['title', 'url']
+
     @classmethod
-    def create(cls, app, **kwargs):
+    def new(cls, app, **kwargs):
         # TODO: check args
         url = kwargs['url']
-        post = ImagePost(app, 'image_post:' + randstr(), 'Image', None, url)
-        app.db.hmset(post.id, post.json())
-        return post
+        return ImagePost(app, 'image_post:' + randstr(), 'Image', None, url)
 
     def __init__(self, app, id, title, posted, url, **kwargs):
         super(ImagePost, self).__init__(app, id, title, posted, **kwargs)
@@ -424,32 +1838,97 @@ class Error(Exception):
 
 class ValueError(Error, exceptions.ValueError): pass
 
+_CLAIM_SCRIPT = """
+-- claim the content key KEYS[1] for the new post KEYS[2], unless it is owned
+-- by another existing post, and store and post it. Returns the owner.
+-- KEYS[3..5]: posts, history, history:<type>
+-- ARGV: score, encoding (packed or hash), packed string or hash items
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= KEYS[2] and redis.call('EXISTS', owner) == 1 then
+    return owner
+end
+redis.call('SET', KEYS[1], KEYS[2])
+redis.call('DEL', KEYS[2])
+if ARGV[2] == 'packed' then
+    redis.call('SET', KEYS[2], ARGV[3])
+else
+    redis.call('HMSET', KEYS[2], unpack(ARGV, 3))
+end
+redis.call('SADD', KEYS[3], KEYS[2])
+redis.call('ZADD', KEYS[4], ARGV[1], KEYS[2])
+redis.call('ZADD', KEYS[5], ARGV[1], KEYS[2])
+return KEYS[2]
+"""
+
+def pack_post(id, hash):
+    """
+    Pack the `hash` of the post with `id` into a compact string: a JSON array of
+    the post type, the time the post was posted, as POSIX timestamp in
+    microseconds (`null` if it was never posted), and the remaining fields.
+    """
+    hash = dict((k, v.decode('utf-8') if isinstance(v, bytes) else unicode(v))
+        for k, v in hash.items())
+    post_type = hash.pop('__type__')
+    posted = hash.pop('posted', 'None')
+    hash.pop('id', None)
+    if posted != 'None':
+        posted = parse_isotime(posted)
+        posted = timegm(posted.utctimetuple()) * 1000000 + posted.microsecond
+    else:
+        posted = None
+    return json.dumps([post_type, posted, hash], ensure_ascii=False,
+        separators=(',', ':')).encode('utf-8')
+
+def unpack_post(id, string):
+    """
+    Unpack the hash of the post with `id` from a `string` produced by
+    `pack_post`.
+    """
+    post_type, posted, hash = json.loads(string.decode('utf-8'))
+    if posted is not None:
+        posted = (datetime(1970, 1, 1) + timedelta(microseconds=posted)
+            ).isoformat()
+    hash['__type__'] = post_type
+    hash['posted'] = unicode(posted)
+    hash['id'] = id.decode('utf-8') if isinstance(id, bytes) else id
+    return hash
+
 def randstr(length=8, charset=ascii_lowercase):
     return ''.join(choice(charset) for i in xrange(length))
 
 # ==== Tests ====
 
-from wall.test import TestCase, CommonPostTest
+from wall.test import (TestCase, TestClient, CommonPostTest, TestPost,
+    test_storage)
+from redis import StrictRedis
+from tornado.testing import gen_test
+from tornado.locks import Event as Flag
+from tornado.concurrent import Future
+from tornado.gen import moment
 from tempfile import NamedTemporaryFile
 
 class WallTest(TestCase):
     def test_init(self):
         # without config file
-        app = WallApp()
+        app = WallApp(config=self.config)
         self.assertTrue(app._init)
 
         # valid config file
         f = NamedTemporaryFile(delete=False)
         f.write('[wall]\ndebug = True\n')
         f.close()
-        app = WallApp(config_path=f.name)
+        app = WallApp(config_path=f.name, config=self.config)
         self.assertTrue(app._init)
 
         # invalid config file
         f = NamedTemporaryFile(delete=False)
         f.write('foo')
         f.close()
-        app = WallApp(config_path=f.name)
+        app = WallApp(config_path=f.name, config=self.config)
+        self.assertFalse(app._init)
+
+        # invalid storage
+        app = WallApp(config=dict(self.config, storage='foo'))
         self.assertFalse(app._init)
 
     def test_post(self):
@@ -468,12 +1947,778 @@ class WallTest(TestCase):
         with self.assertRaises(ValueError):
             self.app.post_new('foo')
 
+    @gen_test
+    def test_post_async(self):
+        post = self.app.post_new('TestPost')
+        other = self.app.post_new('TestPost')
+        same = yield self.app.post_async(post.id)
+        self.assertEqual(post, same)
+        self.assertEqual(self.app.current_post, post)
+        self.assertEqual(post, self.app.get_history()[0])
+        with self.assertRaises(ValueError):
+            yield self.app.post_async('foo')
+
+    @gen_test
+    def test_post_new_async(self):
+        post = yield self.app.post_new_async('TextPost', content='Babylon 5')
+        self.assertIn(post.id, self.app.posts)
+        self.assertEqual(self.app.current_post, post)
+        # sync facade
+        post = yield self.app.post_new_async('TestPost')
+        self.assertIn(post.id, self.app.posts)
+
+    def test_post_new_dedupe(self):
+        post = self.app.post_new('TextPost', content='Babylon 5')
+        self.app.post_new('TextPost', content='Crusade')
+        same = self.app.post_new('TextPost', content=' Babylon 5 ')
+        self.assertEqual(post.id, same.id)
+        self.assertEqual(2, len(self.app.posts))
+        self.assertEqual(same, self.app.get_history()[0])
+        self.assertNotEqual(post.id, self.app.post_new('TestPost').id)
+
+    def test_post_new_batch_dedupe(self):
+        posts = self.app.post_new_batch([
+            {'type': 'ImagePost', 'url': 'https://welcome.b5/logo.png'},
+            {'type': 'ImagePost', 'url': 'https://welcome.b5/logo.png'}
+        ])
+        self.assertEqual(posts[0].id, posts[1].id)
+        self.assertEqual(1, len(self.app.posts))
+
+    @gen_test
+    def test_post_new_async_dedupe(self):
+        post = yield self.app.post_new_async('TextPost', content='Babylon 5')
+        same = yield self.app.post_new_async('TextPost', content='Babylon 5')
+        self.assertEqual(post.id, same.id)
+
+    @gen_test
+    def test_post_new_async_dedupe_concurrent(self):
+        posts = yield [self.app.post_new_async('TextPost', content='Babylon 5'),
+                       self.app.post_new_async('TextPost', content='Babylon 5')]
+        self.assertEqual(posts[0].id, posts[1].id)
+        self.assertEqual(1, len(self.app.posts))
+
+    def test_post_new_dedupe_packed(self):
+        app = WallApp(config=dict(self.config, post_encoding='packed'))
+        self.addCleanup(app.db.a.close)
+        post = app.post_new('TextPost', content='Babylon 5')
+        same = app.post_new('TextPost', content='Babylon 5')
+        self.assertEqual(post.id, same.id)
+        app.db._cache.clear()
+        self.assertEqual(same.posted, app.get_history()[0].posted)
+        self.assertEqual(1, len(app.posts))
+
+    def test_post_new_dedupe_removed(self):
+        post = self.app.post_new('TextPost', content='Babylon 5')
+        key = post.content_key(post.json())
+        self.app.db.set(key, 'text_post:b')
+        other = self.app.post_new('TextPost', content='Babylon 5')
+        self.assertNotEqual(post.id, other.id)
+        self.assertEqual(other.id, self.app.db.get(key))
+        self.assertIn(other.id, self.app.posts)
+
+    def test_post_new_round_trip(self):
+        if test_storage != 'redis':
+            self.skipTest('requires storage = redis')
+        post = self.app.post_new('TextPost', content='Babylon 5')
+        pipelines = []
+        pipeline = self.app.db.r.pipeline
+        def counting_pipeline(*args, **kwargs):
+            pipelines.append(args)
+            return pipeline(*args, **kwargs)
+        self.app.db.r.pipeline = counting_pipeline
+        self.app.post_new('TextPost', content='Crusade')
+        self.assertEqual(1, len(pipelines))
+        self.assertEqual(post, self.app.post_new('TextPost', content='Babylon 5'))
+        self.assertEqual(2, len(self.app.posts))
+
+    @gen_test
+    def test_remove_posts_claimed_content(self):
+        post = self.app.post_new('TextPost', content='Babylon 5')
+        key = post.content_key(post.json())
+        self.app.db.set(key, 'text_post:b')
+        yield self.app._remove_posts_async([post.id])
+        self.assertEqual('text_post:b', self.app.db.get(key))
+
+    @gen_test
+    def test_redis_shards(self):
+        if test_storage != 'redis':
+            self.skipTest('requires storage = redis')
+        app = WallApp(config=dict(self.config,
+            redis_shards='localhost:6379/13 localhost:6379/14'))
+        self.addCleanup(app.db.a.close)
+        app.db.flushdb()
+        posts = [app.post_new('TextPost', content=randstr())
+                 for i in xrange(10)]
+        history = yield app.get_history_async()
+        self.assertEqual(list(reversed(posts)), history)
+        self.assertTrue(StrictRedis(db=13).dbsize())
+        self.assertTrue(StrictRedis(db=14).dbsize())
+
+    def test_post_encoding_packed(self):
+        app = WallApp(config=dict(self.config, post_encoding='packed'))
+        self.addCleanup(app.db.a.close)
+        posts = [app.post_new('TextPost', content='Babylon 5'),
+                 app.post_new('ImagePost', url='https://welcome.b5/logo.png')]
+        app.post(posts[0].id)
+        self.assertEqual('string', app.db.type(posts[0].id))
+        app.db._cache.clear()
+        history = app.get_history()
+        self.assertEqual(posts, history)
+        self.assertEqual(app.current_post.posted, history[0].posted)
+        self.assertEqual('Babylon 5', history[0].content)
+        app.add_post_type(TestPost)
+        post = TestPost.create(app)
+        self.assertEqual('string', app.db.type(post.id))
+
+    def test_pack_post(self):
+        hash = {'id': 'text_post:a', 'title': 'B5', 'content': '\u2605',
+                'posted': '2258-01-01T12:00:00.000250', '__type__': 'TextPost'}
+        self.assertEqual(hash, unpack_post('text_post:a',
+            pack_post('text_post:a', hash)))
+        hash['posted'] = 'None'
+        self.assertEqual(hash, unpack_post('text_post:a',
+            pack_post('text_post:a', hash)))
+
+    def test_post_new_batch(self):
+        posts = self.app.post_new_batch([
+            {'type': 'TextPost', 'content': 'Babylon 5'},
+            {'type': 'TestPost'}
+        ])
+        for post in posts:
+            self.assertIn(post.id, self.app.posts)
+        self.assertEqual(self.app.current_post, posts[-1])
+        self.assertEqual(list(reversed(posts)), self.app.get_history())
+
+    def test_post_new_batch_invalid(self):
+        with self.assertRaises(ValueError):
+            self.app.post_new_batch([])
+        with self.assertRaises(ValueError):
+            self.app.post_new_batch([{'type': 'TestPost'}, {'type': 'foo'}])
+        self.assertFalse(self.app.posts)
+
+    @gen_test
+    def test_post_new_batch_async(self):
+        posts = yield self.app.post_new_batch_async([
+            {'type': 'TextPost', 'content': 'Babylon 5'},
+            {'type': 'TextPost', 'content': 'Crusade'}
+        ])
+        self.assertEqual(self.app.current_post, posts[-1])
+        self.assertEqual(list(reversed(posts)), self.app.get_history())
+
+    @gen_test
+    def test_compact_max_count(self):
+        app = self._retention_app(retention_max_count=2)
+        posts = [app.post_new('TestPost') for i in xrange(3)]
+        yield app._compact()
+        self.assertEqual(list(reversed(posts))[0:2], app.get_history())
+        self.assertNotIn(posts[0].id, app.posts)
+        self.assertFalse(app.db.exists(posts[0].id))
+
+    @gen_test
+    def test_compact_max_age(self):
+        app = self._retention_app(retention_max_age=1)
+        posts = [app.post_new('TestPost') for i in xrange(3)]
+        for post in posts:
+            app.db.zadd('history', 0, post.id)
+        yield app._compact()
+        self.assertEqual([posts[2]], app.get_history())
+
+    @gen_test
+    def test_compact_current_post(self):
+        app = self._retention_app(retention_max_count=2)
+        posts = [app.post_new('TestPost') for i in xrange(3)]
+        app.post(posts[0].id)
+        app.db.zadd('history', 0, posts[0].id)
+        yield app._compact()
+        self.assertEqual([posts[2], posts[0]], app.get_history())
+
+    def test_compaction_disabled(self):
+        app = self._retention_app(retention_max_count=2,
+            compaction_interval='0')
+        self.assertTrue(app._init)
+        self.assertIsNone(app._compaction)
+
+    @gen_test
+    def test_compact_type_limits(self):
+        app = self._retention_app(retention_type_limits='TextPost:1')
+        posts = [app.post_new('TextPost', content='Babylon 5'),
+                 app.post_new('TextPost', content='Crusade'),
+                 app.post_new('TestPost')]
+        yield app._compact()
+        self.assertEqual([posts[2], posts[1]], app.get_history())
+        post = app.post_new('TextPost', content='Babylon 5')
+        self.assertNotEqual(posts[0].id, post.id)
+
+    @gen_test
+    def test_get_history_async(self):
+        posts = []
+        posts.insert(0, self.app.post_new('TestPost'))
+        posts.insert(0, self.app.post_new('TestPost'))
+        history = yield self.app.get_history_async(2)
+        self.assertEqual(posts, history)
+
     def test_get_history(self):
         posts = []
         posts.insert(0, self.app.post_new('TestPost'))
         posts.insert(0, self.app.post_new('TestPost'))
         self.assertEqual(posts, self.app.get_history()[0:2])
 
+    def test_get_history_count(self):
+        posts = [self.app.post_new('TestPost') for i in xrange(3)]
+        self.assertEqual(list(reversed(posts))[0:2], self.app.get_history(2))
+
+    @gen_test
+    def test_get_history_msg(self):
+        posts = [self.app.post_new('TestPost') for i in xrange(2)]
+        msg = Message('get_history', {})
+        response = yield self.app.get_history_msg(msg)
+        self.assertEqual([p.json('common') for p in reversed(posts)],
+            json.loads(str(response))['data'])
+
+        # served from the materialized view
+        posts.append(self.app.post_new('TestPost'))
+        posts[0] = self.app.post(posts[0].id)
+        future = self.app.get_history_msg(msg)
+        self.assertTrue(future.done())
+        self.assertEqual(
+            [p.json('common') for p in [posts[0], posts[2], posts[1]]],
+            json.loads(str(future.result()))['data'])
+
+    @gen_test
+    def test_get_history_msg_cursor(self):
+        posts = [self.app.post_new('TestPost') for i in xrange(3)]
+        @coroutine
+        def get_history(args):
+            response = yield self.app.get_history_msg(
+                Message('get_history', args))
+            raise Return(json.loads(str(response))['data'])
+
+        data = yield get_history({'cursor': None, 'count': 2})
+        self.assertEqual([posts[1].id, posts[0].id],
+            [p['id'] for p in data['posts']])
+        self.assertTrue(data['more'])
+
+        data = yield get_history({'cursor': data['cursor'], 'count': 2})
+        self.assertEqual([posts[2].id], [p['id'] for p in data['posts']])
+        self.assertFalse(data['more'])
+        cursor = data['cursor']
+        self.assertEqual(
+            {'posts': [], 'cursor': cursor, 'more': False, 'reset': False},
+            (yield get_history({'cursor': cursor})))
+
+        # posted again
+        post = self.app.post(posts[0].id)
+        data = yield get_history({'cursor': cursor})
+        self.assertEqual([post.json('common')], data['posts'])
+        self.assertTrue(data['cursor'].endswith(post.posted))
+        self.assertFalse(data['reset'])
+
+    @gen_test
+    def test_get_history_msg_cursor_reset(self):
+        self.app.history_size = 2
+        posts = [self.app.post_new('TestPost') for i in xrange(2)]
+        @coroutine
+        def get_history(cursor):
+            response = yield self.app.get_history_msg(
+                Message('get_history', {'cursor': cursor}))
+            raise Return(json.loads(str(response))['data'])
+        cursor = (yield get_history(None))['cursor']
+
+        # cursor older than the view
+        posts += [self.app.post_new('TestPost') for i in xrange(3)]
+        data = yield get_history(cursor)
+        self.assertTrue(data['reset'])
+        self.assertEqual([posts[4].id, posts[3].id],
+            [p['id'] for p in data['posts']])
+
+        # removed posts
+        yield self.app._remove_posts_async([posts[3].id])
+        data = yield get_history(data['cursor'])
+        self.assertTrue(data['reset'])
+        self.assertEqual([posts[4].id, posts[2].id],
+            [p['id'] for p in data['posts']])
+        data = yield get_history(data['cursor'])
+        self.assertEqual(([], False), (data['posts'], data['reset']))
+
+        # cursors of another epoch, e.g. from before a restart
+        data = yield get_history('2258-01-01T12:00:00')
+        self.assertTrue(data['reset'])
+
+    @gen_test
+    def test_get_history_msg_invalid_count(self):
+        with self.assertRaises(ValueError):
+            yield self.app.get_history_msg(
+                Message('get_history', {'cursor': None, 'count': 0}))
+
+    @gen_test
+    def test_get_history_msg_removed(self):
+        posts = [self.app.post_new('TestPost') for i in xrange(2)]
+        msg = Message('get_history', {})
+        yield self.app.get_history_msg(msg)
+        yield self.app._remove_posts_async([posts[0].id])
+        self.assertIsNone(self.app._history_view)
+        response = yield self.app.get_history_msg(msg)
+        self.assertEqual([posts[1].json('common')],
+            json.loads(str(response))['data'])
+
+    def test_search_history(self):
+        posts = [self.app.post_new('TextPost', content='Babylon 5'),
+                 self.app.post_new('TextPost', content='Babylon 4\nStation'),
+                 self.app.post_new('ImagePost', url='https://welcome.b5/s.png')]
+        self.assertEqual([posts[1], posts[0]],
+            self.app.search_history('babylon'))
+        self.assertEqual([posts[1]], self.app.search_history('bab STAT'))
+        self.assertEqual([posts[2]], self.app.search_history('welcome'))
+        self.assertEqual([posts[1]], self.app.search_history('babylon', 1))
+
+        self.app.post(posts[0].id)
+        self.assertEqual([posts[0], posts[1]],
+            self.app.search_history('babylon'))
+
+    def test_search_history_rebuild(self):
+        post = self.app.post_new('TextPost', content='Babylon 5')
+        self.app.search_index = SearchIndex()
+        self.app._build_search_index()
+        self.assertEqual([post], self.app.search_history('babylon'))
+
+    @gen_test
+    def test_search_history_msg(self):
+        posts = [self.app.post_new('TextPost', content='Babylon 5'),
+                 self.app.post_new('TextPost', content='Babylon 4')]
+        yield self.app._remove_posts_async([posts[1].id])
+        response = yield self.app.search_history_msg(
+            Message('search_history', {'query': 'babylon'}))
+        self.assertEqual([posts[0].json('common')], response.data)
+
+    def test_migrate_history_index(self):
+        posts = []
+        posts.insert(0, self.app.post_new('TestPost'))
+        posts.insert(0, self.app.post_new('TestPost'))
+        self.app.db.delete('history')
+        self.app._migrate_history_index()
+        self.assertEqual(posts, self.app.get_history())
+
+    def _retention_app(self, **config):
+        app = WallApp(config=dict(self.config, **config))
+        app.add_post_type(TestPost)
+        if app._compaction:
+            app._compaction.stop()
+        self.addCleanup(app.db.a.close)
+        return app
+
+class SocketTest(TestCase):
+    def setUp(self):
+        super(SocketTest, self).setUp()
+        # slow requests are pending until a fast request is handled
+        self.handled = Flag()
+        @coroutine
+        def slow_msg(msg):
+            if msg.data.get('fail'):
+                raise ValueError('fail')
+            yield self.handled.wait()
+            raise Return(Message('slow', msg.data))
+        def fast_msg(msg):
+            self.handled.set()
+            return Message('fast', msg.data)
+        self.app.add_message_handler('slow', slow_msg)
+        self.app.add_message_handler('fast', fast_msg)
+
+    @gen_test
+    def test_request_id(self):
+        ws = yield self.connect()
+        ws.write_message(json.dumps({'type': 'slow', 'data': {}, 'id': 1}))
+        ws.write_message(json.dumps({'type': 'fast', 'data': {}, 'id': 2}))
+        messages = yield self.receive(ws, 2)
+        self.assertEqual([('fast', 2), ('slow', 1)],
+            [(m['type'], m['id']) for m in messages])
+
+    @gen_test
+    def test_error(self):
+        ws = yield self.connect()
+        ws.write_message(json.dumps({'type': 'slow', 'data': {'fail': True}}))
+        message = (yield self.receive(ws, 1))[0]
+        self.assertEqual({'args': ['fail'], '__type__': 'ValueError'},
+            message['data'])
+
+    @gen_test
+    def test_client_max_requests(self):
+        self.app.client_max_requests = 1
+        ws = yield self.connect()
+        ws.write_message(json.dumps({'type': 'slow', 'data': {}, 'id': 1}))
+        ws.write_message(json.dumps({'type': 'slow', 'data': {}, 'id': 2}))
+        message = (yield self.receive(ws, 1))[0]
+        self.assertEqual(2, message['id'])
+        self.assertEqual(['too_many_requests'], message['data']['args'])
+        self.handled.set()
+        message = (yield self.receive(ws, 1))[0]
+        self.assertEqual(({}, 1), (message['data'], message['id']))
+
+    @gen_test
+    def test_sendall(self):
+        wss = [(yield self.connect()) for i in xrange(3)]
+        self.app.sendall(Message('fast', {'n': 1}))
+        self.app.sendall(Message('fast', {'n': 2}), self.app.clients[1:])
+        for ws in wss[1:]:
+            messages = yield self.receive(ws, 2)
+            self.assertEqual([{'n': 1}, {'n': 2}], [m['data'] for m in messages])
+        messages = yield self.receive(wss[0], 1)
+        self.assertEqual({'n': 1}, messages[0]['data'])
+
+    @gen_test
+    def test_send_lagging(self):
+        self.app.client_max_buffer = 0
+        self.app.set_message_delivery('drop', 'droppable')
+        self.app.set_message_delivery('replace', 'replaceable')
+        yield self.connect()
+        client = self.app.clients[0]
+        # simulate a client which does not receive anything
+        written = []
+        writes = []
+        def write_message(msgstr, binary=False):
+            written.append(json.loads(msgstr)['data'])
+            writes.append(Future())
+            return writes[-1]
+        client.write_message = write_message
+
+        for msg in [Message('fast', 1), Message('drop', 2),
+                    Message('replace', 3), Message('fast', 4),
+                    Message('replace', 5)]:
+            client.send(msg)
+        yield moment
+        self.assertEqual([1, 4], written)
+        writes[0].set_result(None)
+        yield moment
+        self.assertEqual([1, 4], written)
+        writes[1].set_result(None)
+        yield moment
+        self.assertEqual([1, 4, 5], written)
+
+        closed = []
+        client.close = lambda: closed.append(True)
+        self.app.client_lag_timeout = 0
+        client.send(Message('fast', 6))
+        client.send(Message('fast', 7))
+        yield moment
+        self.assertEqual([1, 4, 5, 6], written)
+        self.assertTrue(closed)
+
+    @gen_test
+    def test_send_batch(self):
+        ws = yield self.connect(batch='1')
+        self.app.sendall(Message('fast', 1))
+        self.app.sendall(Message('fast', 2))
+        messages = yield self.receive(ws, 1)
+        self.assertEqual([1, 2], [m['data'] for m in messages[0]])
+
+        self.app.sendall(Message('fast', 3))
+        messages = yield self.receive(ws, 1)
+        self.assertEqual(3, messages[0]['data'])
+        # the brackets and separators of batches are not accounted
+        self.assertEqual(0, self.app.clients[0]._buffered)
+
+    @gen_test
+    def test_compression(self):
+        self.app.compression_min_size = 100
+        ws = yield self.connect(compression_options={})
+        self.app.sendall(Message('fast', 'x' * 1000))
+        self.app.sendall(Message('fast', 'y'))
+        messages = yield self.receive(ws, 2)
+        self.assertEqual(['x' * 1000, 'y'], [m['data'] for m in messages])
+        self.assertEqual(1, self.app.compression_stats['messages'])
+        self.assertLess(self.app.compression_stats['compressed_bytes'],
+            self.app.compression_stats['bytes'])
+
+    @gen_test
+    def test_compression_no_context_takeover(self):
+        self.app.compression_context_takeover = False
+        ws = yield self.connect(compression_options={})
+        self.app.sendall(Message('fast', 'x' * 1000))
+        messages = yield self.receive(ws, 1)
+        self.assertEqual('x' * 1000, messages[0]['data'])
+        self.assertIsNone(ws.protocol._decompressor._decompressor)
+
+    @gen_test
+    def test_encoding_msgpack(self):
+        if not msgpack:
+            self.skipTest('requires msgpack')
+        ws = yield self.connect(subprotocols=['msgpack', 'json'], batch='1')
+        ws.write_message(Message('fast', {'x': '\xfc'}, id=1).pack(),
+            binary=True)
+        message = msgpack.unpackb((yield ws.read_message()), raw=False)
+        self.assertEqual({'type': 'fast', 'data': {'x': '\xfc'}, 'id': 1},
+            message)
+
+        self.app.sendall(Message('fast', 2))
+        self.app.sendall(Message('fast', 3))
+        messages = msgpack.unpackb((yield ws.read_message()), raw=False)
+        self.assertEqual([2, 3], [m['data'] for m in messages])
+
+    @gen_test
+    def test_binary_message_without_msgpack(self):
+        module = sys.modules[__name__]
+        self.addCleanup(setattr, module, 'msgpack', module.msgpack)
+        module.msgpack = None
+        ws = yield self.connect()
+        ws.write_message(b'\x80', binary=True)
+        self.assertIsNone((yield ws.read_message()))
+        self.assertEqual(1003, ws.close_code)
+
+    def test_prepared_message_id(self):
+        msg = PreparedMessage('posted', {'id': 'a'})
+        msg.id = 1
+        self.assertEqual(str(Message('posted', {'id': 'a'}, id=1)), str(msg))
+        if msgpack:
+            self.assertEqual(Message('posted', {'id': 'a'}, id=1).pack(),
+                msg.pack())
+
+class HeartbeatTest(TestCase):
+    def test_heartbeat_disabled(self):
+        app = WallApp(config=dict(self.config, heartbeat_interval='0'))
+        self.addCleanup(app.db.a.close)
+        self.assertTrue(app._init)
+        self.assertIsNone(app._heartbeat_timer)
+
+    @gen_test
+    def test_heartbeat(self):
+        yield self.connect()
+        client = self.app.clients[0]
+        last_seen = client._last_seen = time() - 60
+        self.app.heartbeat_timeout = 75
+        self.app._heartbeat()
+        while client._last_seen == last_seen:
+            yield moment
+        self.assertEqual([client], self.app.clients)
+
+    @gen_test
+    def test_heartbeat_closing_client(self):
+        yield [self.connect(), self.connect()]
+        closing, client = self.app.clients
+        closing.close()
+        self.assertEqual(2, len(self.app.clients))
+        client._last_seen = 0
+        self.app._heartbeat()
+        while client in self.app.clients:
+            yield moment
+        self.assertEqual(1, self.app.client_stats['reaped'])
+
+    @gen_test
+    def test_heartbeat_dead_client(self):
+        disconnected = []
+        self.app.add_event_listener('disconnected',
+            lambda event: disconnected.append(event))
+        yield self.connect()
+        client = self.app.clients[0]
+        client._last_seen = 0
+        self.app._heartbeat()
+        while self.app.clients:
+            yield moment
+        self.assertEqual(1, len(disconnected))
+        self.assertEqual({'connected': 1, 'reaped': 1}, self.app.client_stats)
+
+class TopicTest(TestCase):
+    def setUp(self):
+        super(TopicTest, self).setUp()
+        self.clients = [TestClient(), TestClient()]
+        self.app.subscribe(self.clients[0], 'ships')
+        self.app.subscribe(self.clients[1], 'ships')
+        self.app.subscribe(self.clients[1], 'stations')
+
+    def test_publish(self):
+        self.app.publish('ships', Message('update', 'Starfury'))
+        self.app.publish('stations', Message('update', 'Babylon 5'))
+        self.app.publish('planets', Message('update', 'Minbar'))
+        self.assertEqual(['Starfury'],
+            [m.data for m in self.clients[0].messages])
+        self.assertEqual(['Starfury', 'Babylon 5'],
+            [m.data for m in self.clients[1].messages])
+
+    def test_unsubscribe(self):
+        self.app.unsubscribe(self.clients[1], 'ships')
+        self.app.unsubscribe(self.clients[1], 'stations')
+        self.app.unsubscribe(self.clients[1], 'planets')
+        self.app.publish('ships', Message('update', 'Starfury'))
+        self.assertEqual([], self.clients[1].messages)
+        self.assertEqual(set(), self.clients[1].topics)
+        self.assertNotIn('stations', self.app.topics)
+
+    @gen_test
+    def test_subscribe_msg(self):
+        ws = yield self.connect()
+        ws.write_message(json.dumps(
+            {'type': 'subscribe', 'data': {'topic': 'ships'}}))
+        yield ws.read_message()
+        self.app.publish('ships', Message('update', 'Starfury'))
+        message = json.loads((yield ws.read_message()))
+        self.assertEqual('Starfury', message['data'])
+
+        # subscriptions end with the session
+        self.app.session_timeout = 0
+        ws.close()
+        while self.app.sessions:
+            yield moment
+        self.assertEqual(set(self.clients), self.app.topics['ships'])
+
+    def test_subscribe_msg_invalid_topic(self):
+        with self.assertRaises(ValueError):
+            self.app.subscribe_msg(Message('subscribe', {}, self.clients[0]))
+
+class SessionTest(TestCase):
+    @coroutine
+    def disconnect(self, ws):
+        ws.close()
+        while self.app.clients:
+            yield moment
+
+    @gen_test
+    def test_resume(self):
+        self.app.set_message_delivery('drop', 'droppable')
+        ws = yield self.connect()
+        session = self.app.clients[0].session
+        self.app.sendall(Message('update', 'Starfury'))
+        seq = json.loads((yield ws.read_message()))['seq']
+        yield self.disconnect(ws)
+        self.app.sendall(Message('update', 'White Star'))
+        self.app.sendall(Message('drop', 'Thunderbolt'))
+        self.app.publish('posted', Message('update', 'Babylon 5'))
+
+        ws = yield self.connect(session=session.id, seq=seq)
+        self.assertIs(session, self.app.clients[0].session)
+        messages = [json.loads((yield ws.read_message())) for i in xrange(2)]
+        self.assertEqual(['White Star', 'Babylon 5'],
+            [m['data'] for m in messages])
+        self.assertLess(seq, messages[0]['seq'])
+        self.assertLess(messages[0]['seq'], messages[1]['seq'])
+
+    @gen_test
+    def test_resume_lost_messages(self):
+        self.app.session_replay_size = 1
+        ws = yield self.connect()
+        session = self.app.clients[0].session
+        yield self.disconnect(ws)
+        self.app.sendall(Message('update', 'White Star'))
+        self.app.sendall(Message('update', 'Babylon 5'))
+
+        ws = yield self.connect(session=session.id, seq=0)
+        self.assertIsNot(session, self.app.clients[0].session)
+        self.assertIn('posted', self.app.clients[0].topics)
+
+    @gen_test
+    def test_resume_take_over(self):
+        old = yield self.connect()
+        session = self.app.clients[0].session
+        ws = yield self.connect(session=session.id, seq=0)
+        self.assertIsNone((yield old.read_message()))
+        while len(self.app.clients) > 1:
+            yield moment
+        self.assertIs(session, self.app.clients[0].session)
+        self.assertIs(self.app.clients[0], session.socket)
+
+    @gen_test
+    def test_end(self):
+        self.app.session_timeout = 0
+        ws = yield self.connect()
+        session = self.app.clients[0].session
+        yield self.disconnect(ws)
+        while self.app.sessions:
+            yield moment
+        self.assertEqual({}, self.app.topics)
+
+        ws = yield self.connect(session=session.id, seq=0)
+        self.assertIsNot(session, self.app.clients[0].session)
+
+class RestartTest(TestCase):
+    @gen_test
+    def test_restore(self):
+        app = WallApp(config=self.config)
+        self.addCleanup(app.db.a.close)
+        session = Session(app)
+        app.sessions[session.id] = session
+        app.subscribe(session, 'posted')
+        app.subscribe(session, 'volume')
+        app.sendall(Message('update', 'Starfury'))
+        app.sendall(Message('update', 'White Star'))
+
+        self.app.restore(json.loads(json.dumps(app.snapshot())))
+        ws = yield self.connect(session=session.id, seq=1)
+        self.assertEqual(session.id, self.app.clients[0].session.id)
+        self.assertEqual({'posted', 'volume'}, self.app.clients[0].topics)
+        msg = json.loads((yield ws.read_message()))
+        self.assertEqual(('White Star', 2), (msg['data'], msg['seq']))
+        self.app.sendall(Message('update', 'Babylon 5'))
+        msg = json.loads((yield ws.read_message()))
+        self.assertEqual(3, msg['seq'])
+
+    def test_restore_current_post(self):
+        posts = [self.app.post_new('TextPost', content='Babylon 5'),
+                 self.app.post_new('TextPost', content='Babylon 4')]
+        snapshot = self.app.snapshot()
+        self.app.post(posts[0].id)
+        self.app.restore(snapshot)
+        self.assertEqual(posts[1], self.app.current_post)
+
+    def test_init_current_post(self):
+        if test_storage != 'redis':
+            self.skipTest('requires storage = redis')
+        post = self.app.post_new('TextPost', content='Babylon 5')
+        app = WallApp(config=self.config)
+        self.addCleanup(app.db.a.close)
+        self.assertEqual(post, app.current_post)
+
+    @gen_test
+    def test_hand_over(self):
+        ws = yield self.connect()
+        self.app._server = HTTPServer(self.app)
+        channel, child_channel = socket.socketpair()
+        self.addCleanup(child_channel.close)
+        child_channel.sendall(b'ready')
+        yield self.app._hand_over(IOStream(channel), _Process(0))
+        IOLoop.current().remove_timeout(self.app._exit)
+
+        self.assertIsNone((yield ws.read_message()))
+        self.assertEqual(1012, ws.close_code)
+        snapshot = json.loads(b''.join(iter(lambda: child_channel.recv(65536), b'')))
+        self.assertEqual(self.app.snapshot(), snapshot)
+
+    @gen_test
+    def test_hand_over_failed_restart(self):
+        ws = yield self.connect()
+        channel, child_channel = socket.socketpair()
+        child_channel.close()
+        self.app._restarting = True
+        yield self.app._hand_over(IOStream(channel), _Process(1))
+
+        self.assertFalse(self.app._restarting)
+        self.assertIsNone(self.app._exit)
+        self.app.sendall(Message('update', 'Babylon 5'))
+        msg = json.loads((yield ws.read_message()))
+        self.assertEqual('Babylon 5', msg['data'])
+
+class _Process(object):
+    # stub of a subprocess.Popen
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+    def wait(self):
+        return self.returncode
+
+class PostTest(TestCase):
+    def test_fields(self):
+        self.assertEqual(['id', 'title', 'posted', 'content'],
+            TextPost.fields())
+        post = TextPost(self.app, 'text_post:a', 'Babylon 5', None, 'B5')
+        self.assertFalse(hasattr(post, '__dict__'))
+        self.assertEqual({'id': 'text_post:a', 'title': 'Babylon 5',
+            'posted': None, 'content': 'B5', '__type__': 'TextPost'},
+            post.json())
+
+    def test_json_without_slots(self):
+        post = TestPost(self.app, 'test_post:a', 'Test', None)
+        self.assertEqual({'id': 'test_post:a', 'title': 'Test', 'posted': None,
+            'activate_called': False, 'deactivate_called': False,
+            '__type__': 'TestPost'}, post.json())
+        post.activate()
+        self.assertTrue(post.json()['activate_called'])
+
 class TextPostTest(TestCase, CommonPostTest):
     def setUp(self):
         super(TextPostTest, self).setUp()
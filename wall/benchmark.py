@@ -0,0 +1,97 @@
+# Wall
+
+# Benchmark of the storage engines (see the storage option).
+#
+# Usage: python -m wall.benchmark [post_count] [config_file]
+#
+# The redis engine uses the Redis database 15, which is flushed, and is skipped
+# if no Redis server is available. If the config file sets redis_shards, the
+# database 15 of every shard is used instead, so the shards must not give a
+# database index. The sqlite engine uses a temporary file.
+
+# Python forward compatibility
+from __future__ import (division, absolute_import, print_function,
+    unicode_literals)
+
+import sys
+import os
+from shutil import rmtree
+from time import time
+from random import choice
+from collections import OrderedDict
+from tempfile import mkdtemp
+from logging import getLogger, CRITICAL
+from ConfigParser import SafeConfigParser
+from redis.exceptions import ConnectionError
+from wall import WallApp, randstr, res_path
+
+def benchmark(storage, count, path=None, shards=''):
+    """
+    Benchmark the storage engine `storage` with `count` posts. `path` is the
+    path of the SQLite database file and `shards` the Redis shards (see the
+    redis_shards option).
+
+    Returns the throughput in operations per second per operation, an ordered
+    `dict`. The post cache is disabled, so that every operation hits the storage
+    engine.
+    """
+    app = WallApp(config={'storage': storage, 'db': 15, 'sqlite_path': path,
+                          'redis_shards': shards if storage == 'redis' else '',
+                          'cache_size': 0, 'bricks': ''})
+    if storage == 'redis':
+        app.db.flushdb()
+    results = OrderedDict()
+
+    t = time()
+    ids = [app.post_new('TextPost', content=randstr()).id
+           for i in xrange(count)]
+    results['post_new'] = count / (time() - t)
+
+    t = time()
+    for i in xrange(count):
+        app.post(choice(ids))
+    results['post'] = count / (time() - t)
+
+    t = time()
+    for i in xrange(count):
+        app.posts[choice(ids)]
+    results['get'] = count / (time() - t)
+
+    repeat = max(count // app.history_size, 1)
+    t = time()
+    for i in xrange(repeat):
+        app.get_history()
+    results['get_history'] = repeat / (time() - t)
+
+    app.db.a.close()
+    return results
+
+def main(args):
+    count = int(args[0]) if args else 1000
+    parser = SafeConfigParser()
+    parser.read([os.path.join(res_path, 'default.cfg')] + args[1:2])
+    shards = parser.get('wall', 'redis_shards')
+    getLogger('wall').setLevel(CRITICAL)
+    path = mkdtemp()
+
+    print('{} posts, operations per second'.format(count))
+    header = None
+    for storage in ['memory', 'sqlite', 'redis']:
+        if storage == 'redis':
+            try:
+                results = benchmark(storage, count, shards=shards)
+            except ConnectionError:
+                print('{:8} unavailable'.format(storage))
+                continue
+        else:
+            results = benchmark(storage, count, os.path.join(path, 'wall.db'))
+        if not header:
+            header = ''.join('{:>12}'.format(k) for k in results)
+            print(' ' * 8 + header)
+        print('{:8}'.format(storage) +
+            ''.join('{:12.0f}'.format(v) for v in results.values()))
+    rmtree(path)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
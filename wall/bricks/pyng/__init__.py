@@ -22,6 +22,7 @@ class PyngBrick(Brick):
         self.app.add_message_handler('pyng.subscribe', self._subscribe_msg)
         self.app.add_message_handler('pyng.join', self._join_msg)
         self.app.add_message_handler('pyng.update', self._update_msg)
+        self.app.set_message_delivery('pyng.update', 'replaceable')
 
     def _subscribe_msg(self, msg):
         # TODO: include id in Pyng messages, use it for routing and move the
@@ -49,14 +50,12 @@ class PyngBrick(Brick):
             pass
 
 class PyngPost(Post):
+    __slots__ = ['tps', 'win_score', 'mode', 'players', 'ball', 'goals',
+                 '_topic', '_ticks', '_clock']
+
     @classmethod
-    def create(cls, app, **kwargs):
-        try:
-            return app.posts['pyng_post:pyng_post']
-        except KeyError:
-            post = PyngPost(app, 'pyng_post:pyng_post', 'Pyng', None)
-            app.db.hmset(post.id, post.json())
-            return post
+    def new(cls, app, **kwargs):
+        return PyngPost(app, 'pyng_post:pyng_post', 'Pyng', None)
 
     def __init__(self, app, id, title, posted, **kwargs):
         super(PyngPost, self).__init__(app, id, title, posted, **kwargs)
@@ -65,7 +64,8 @@ class PyngPost(Post):
         self.win_score = int(self.app.config.get('pyng.win_score', '10'))
 
         self.mode = 'lobby'
-        self.subscribers = []
+        # subscribers receive the match updates
+        self._topic = 'pyng:' + self.id
         self.players = []
         self.ball = None
         self.goals = [Goal(5.0, 40.0), Goal(95.0, 60.0)]
@@ -73,24 +73,19 @@ class PyngPost(Post):
         self._ticks = 0
         self._clock = PeriodicCallback(self._tick, int(1000 / self.tps))
 
-    def activate(self):
-        # TODO: remove event listener when post is removed from wall
-        self.app.add_event_listener('disconnected', self._disconnected)
-
     def deactivate(self):
         self._stop()
-        self.subscribers = []
+        for user in list(self.app.topics.get(self._topic, [])):
+            self.app.unsubscribe(user, self._topic)
 
     def subscribe(self, user):
-        self.subscribers.append(Subscriber(randstr(), user))
+        self.app.subscribe(user, self._topic)
         return self.players
 
     def unsubscribe(self, user):
-        try:
-            subscriber = filter(lambda s: s.user == user, self.subscribers)[0]
-        except IndexError:
+        if self._topic not in user.topics:
             raise ValueError('user')
-        self.subscribers.remove(subscriber)
+        self.app.unsubscribe(user, self._topic)
 
     def join(self, user):
         if self.mode != 'lobby':
@@ -189,19 +184,7 @@ class PyngPost(Post):
         self._ticks += 1
 
     def _send_to_subscribers(self, msg):
-        for subscriber in self.subscribers:
-            subscriber.user.send(msg)
-
-    def _disconnected(self, event):
-        try:
-            self.unsubscribe(event.args['client'])
-        except ValueError:
-            pass
-
-class Subscriber(object):
-    def __init__(self, id, user):
-        self.id = id
-        self.user = user
+        self.app.publish(self._topic, msg)
 
 class Player(object):
     def __init__(self, id, user):
@@ -250,3 +233,15 @@ def collides(p, box):
         and p.x > box.x - w2)
 
 Brick = PyngBrick
+
+# ==== Tests ====
+
+import json
+from wall.test import TestCase
+
+class PyngPostTest(TestCase):
+    def test_post(self):
+        post = self.app.post_new('PyngPost')
+        self.assertEqual(post, self.app.current_post)
+        self.assertEqual(['__type__', 'id', 'posted', 'title'],
+            sorted(json.loads(post.json_str())))
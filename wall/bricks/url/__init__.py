@@ -10,6 +10,7 @@ from wall import Brick, Post, Message, randstr
 from wall.util import WebAPI, Pool
 from urllib import urlencode
 from tornado.httpclient import AsyncHTTPClient
+from tornado.concurrent import Future
 from functools import partial
 
 class UrlBrick(Brick):
@@ -79,21 +80,26 @@ class UrlBrick(Brick):
         return Message('url.get_search_handlers', handlers)
 
     def _search_msg(self, msg):
+        future = Future()
         def cb(results):
-            msg.frm.send(Message('url.search', [vars(r) for r in results]))
+            future.set_result(
+                Message('url.search', [vars(r) for r in results]))
         self.search(msg.data['query'], cb)
+        return future
 
 class UrlPost(Post):
+    __slots__ = ['url']
+    content_fields = ['url']
+    search_fields = ['title', 'url']
+
     @classmethod
-    def create(cls, app, **kwargs):
+    def new(cls, app, **kwargs):
         url = kwargs['url'].strip()
         if not url:
             raise ValueError('url')
         if not url.startswith(('http://', 'https://')):
             url = 'http://' + url
-        post = UrlPost(app, 'url_post:' + randstr(), url, None, url)
-        app.db.hmset(post.id, post.json())
-        return post
+        return UrlPost(app, 'url_post:' + randstr(), url, None, url)
 
     def __init__(self, app, id, title, posted, url, **kwargs):
         super(UrlPost, self).__init__(app, id, title, posted, **kwargs)
@@ -18,6 +18,10 @@ class Brick(_Brick):
     js_module = 'wall.volume'
     post_type = 'VolumePost'
 
+    def __init__(self, app):
+        super(Brick, self).__init__(app)
+        self.app.set_message_delivery('volume.update', 'replaceable')
+
     # for client interface
     def set_volume(self, msg):
         # TODO: read device and interval from config
@@ -34,7 +38,7 @@ class Brick(_Brick):
 
         # trigger the display
         new_post = VolumePost(randstr(), self.get_volume())
-        self.app.sendall(Message('volume.update', vars(new_post)))
+        self.app.publish('volume', Message('volume.update', vars(new_post)))
 
     def get_volume(self):
         # TODO: read device and interval from config
@@ -11,6 +11,7 @@ wall.volume = {};
 ns.Brick = function(ui) {
     wall.Brick.call(this, ui);
     this.ui.msgHandlers["volume.update"] = this.updateVolume;
+    this.ui.subscribe("volume");
 };
 
 $.extend(ns.Brick.prototype, wall.Brick.prototype, {
@@ -8,6 +8,7 @@ import json
 from wall import Brick as _Brick, randstr, Message
 from urllib import urlencode
 from tornado.httpclient import AsyncHTTPClient
+from tornado.concurrent import Future
 
 # TODO: port to new brick architecture. Merge with Youtube part of URL brick.
 # Create YoutubePost from content, once available.
@@ -87,9 +88,11 @@ class Brick(_Brick):
             self.logger.error(self.id + 'AsyncHTTPClient fetch error: ' + e)
 
     def _search_msg(self, msg):
+        future = Future()
         def cb(results):
-            msg.frm.send(Message(msg.type, results))
+            future.set_result(Message(msg.type, results))
         self.search(msg.data['query'], cb)
+        return future
 
 class YoutubePost(object):
     def __init__(self, id, videoid, url, title):
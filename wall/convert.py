@@ -0,0 +1,198 @@
+# Wall
+
+# Tool for converting the encoding of the posts in the database (see the
+# post_encoding option). Wall must not be running while posts are converted.
+#
+# Usage: python -m wall.convert <hash|packed|check> [config_file]
+#
+#  * hash / packed: convert all posts to the given encoding
+#  * check: verify that all posts can be converted without loss
+
+# Python forward compatibility
+from __future__ import (division, absolute_import, print_function,
+    unicode_literals)
+
+import sys
+import os
+from ConfigParser import SafeConfigParser
+from redis.exceptions import ResponseError
+from wall import res_path, pack_post, unpack_post
+from wall.storage import open_engine
+
+key_types = {'hash': 'hash', 'packed': 'string'}
+
+def convert(r, encoding, verify=True):
+    """
+    Convert all posts in the database `r` to the given `encoding`
+    (`hash` or `packed`). Posts which already have the encoding are skipped.
+
+    If `verify` is set, every converted post is read back and compared to the
+    original. On a mismatch, the original is restored.
+
+    Returns statistics, a `dict` with the number of `posts`, `converted` and
+    `failed` posts, as well as the memory usage of all posts in bytes before
+    (`bytes_before`) and after (`bytes_after`) the conversion.
+    """
+    stats = {'posts': 0, 'converted': 0, 'failed': 0, 'bytes_before': 0,
+             'bytes_after': 0}
+    for id in r.sscan_iter('posts', count=100):
+        key_type = r.type(id)
+        if key_type not in key_types.values():
+            continue
+        stats['posts'] += 1
+        size = memory_usage(r, id)
+        stats['bytes_before'] += size
+        if key_type == key_types[encoding]:
+            stats['bytes_after'] += size
+            continue
+
+        original = load(r, id)
+        store(r, id, original, encoding)
+        if verify and normalize(load(r, id)) != normalize(original):
+            store(r, id, original, 'packed' if key_type == 'string' else 'hash')
+            stats['failed'] += 1
+            stats['bytes_after'] += size
+            continue
+        stats['converted'] += 1
+        stats['bytes_after'] += memory_usage(r, id)
+    return stats
+
+def check(r):
+    """
+    Verify that all posts in the database `r` can be converted to both
+    encodings without loss.
+
+    Returns statistics, a `dict` with the number of `posts` per encoding (`hash`
+    and `packed`), the number of `failed` posts, the `ids` of the failed posts
+    and the memory usage in bytes of all posts per encoding (`bytes_hash` and
+    `bytes_packed`).
+    """
+    stats = {'hash': 0, 'packed': 0, 'failed': 0, 'ids': [], 'bytes_hash': 0,
+             'bytes_packed': 0}
+    for id in r.sscan_iter('posts', count=100):
+        key_type = r.type(id)
+        encoding = {'hash': 'hash', 'string': 'packed'}.get(key_type)
+        if not encoding:
+            continue
+        stats[encoding] += 1
+        stats['bytes_' + encoding] += memory_usage(r, id)
+
+        hash = load(r, id)
+        try:
+            same = normalize(unpack_post(id, pack_post(id, hash)))
+        except (KeyError, ValueError):
+            same = None
+        if same != normalize(hash):
+            stats['failed'] += 1
+            stats['ids'].append(id)
+    return stats
+
+def load(r, id):
+    if r.type(id) == 'string':
+        return unpack_post(id, r.get(id))
+    return r.hgetall(id)
+
+def store(r, id, hash, encoding):
+    pipe = r.pipeline()
+    pipe.delete(id)
+    if encoding == 'packed':
+        pipe.set(id, pack_post(id, hash))
+    else:
+        pipe.hmset(id, hash)
+    pipe.execute()
+
+def normalize(hash):
+    return dict((k, v.decode('utf-8') if isinstance(v, bytes) else v)
+        for k, v in hash.items())
+
+def memory_usage(r, key):
+    """
+    Return the number of bytes the `key` and its value take up in the database
+    `r`. For Redis < 4, the size of the serialized value is returned instead and
+    for other storage engines the size of the stored data.
+    """
+    try:
+        return r.execute_command('MEMORY', 'USAGE', key) or 0
+    except ResponseError:
+        return len(r.dump(key) or b'')
+    except AttributeError:
+        if r.type(key) == 'string':
+            return len(r.get(key))
+        return sum(len(k) + len(v) for k, v in r.hgetall(key).items())
+
+def main(args):
+    if len(args) < 1 or args[0] not in ['hash', 'packed', 'check']:
+        print('usage: python -m wall.convert <hash|packed|check> [config_file]',
+            file=sys.stderr)
+        return 2
+
+    parser = SafeConfigParser()
+    parser.read([os.path.join(res_path, 'default.cfg')] + args[1:2])
+    shards = [s.split(',') for s in parser.get('wall', 'redis_shards').split()]
+    r, a = open_engine(parser.get('wall', 'storage'),
+        db=int(parser.get('wall', 'db')), path=parser.get('wall', 'sqlite_path'),
+        shards=shards)
+
+    if args[0] == 'check':
+        stats = check(r)
+        print('{hash} hash post(s), {packed} packed post(s), {failed} failed'
+            .format(**stats))
+        for encoding in ['hash', 'packed']:
+            if stats[encoding]:
+                print('{}: {:.0f} bytes per post'.format(encoding,
+                    stats['bytes_' + encoding] / stats[encoding]))
+        for id in stats['ids']:
+            print('failed: {}'.format(id))
+    else:
+        stats = convert(r, args[0])
+        print('{posts} post(s), {converted} converted, {failed} failed'
+            .format(**stats))
+        if stats['posts']:
+            print('{:.0f} bytes per post before, {:.0f} after'.format(
+                stats['bytes_before'] / stats['posts'],
+                stats['bytes_after'] / stats['posts']))
+    return 1 if stats['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+
+# ==== Tests ====
+
+from unittest import TestCase
+from wall.test import test_storage
+
+class ConvertTest(TestCase):
+    def setUp(self):
+        self.r = open_engine(test_storage, db=15, path=':memory:')[0]
+        self.r.flushdb()
+        self.posts = {
+            'text_post:a': {'id': 'text_post:a', 'title': 'Babylon 5',
+                'content': 'Babylon 5', 'posted': '2258-01-01T12:00:00',
+                '__type__': 'TextPost'},
+            'image_post:b': {'id': 'image_post:b', 'title': 'Image',
+                'url': 'https://welcome.b5/logo.png', 'posted': 'None',
+                '__type__': 'ImagePost'}
+        }
+        for id, hash in self.posts.items():
+            self.r.hmset(id, hash)
+            self.r.sadd('posts', id)
+
+    def test_convert(self):
+        stats = convert(self.r, 'packed')
+        self.assertEqual(2, stats['converted'])
+        self.assertFalse(stats['failed'])
+        self.assertTrue(stats['bytes_before'] and stats['bytes_after'])
+        for id, hash in self.posts.items():
+            self.assertEqual('string', self.r.type(id))
+            self.assertEqual(hash, unpack_post(id, self.r.get(id)))
+
+        stats = convert(self.r, 'hash')
+        self.assertEqual(2, stats['converted'])
+        for id, hash in self.posts.items():
+            self.assertEqual(hash, self.r.hgetall(id))
+
+    def test_check(self):
+        self.r.hset('text_post:a', 'posted', 'foo')
+        stats = check(self.r)
+        self.assertEqual(2, stats['hash'])
+        self.assertEqual(['text_post:a'], stats['ids'])
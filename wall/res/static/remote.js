@@ -17,6 +17,8 @@ ns.RemoteUi = function(bricks, doPostHandlers) {
     this.doPostHandlers = [];
     this.screenStack = [];
     this.mainScreen = null;
+    this.history = [];
+    this.historyCursor = null;
 
     window.onerror = $.proxy(this._erred, this);
     this.addEventListener("posted", this._posted.bind(this));
@@ -109,6 +111,31 @@ ns.RemoteUi.prototype = Object.create(wall.Ui.prototype, {
         this.call("post_new", $.extend({"type": type}, args), callback);
     }},
 
+    /**
+     * Update `history` with the posts posted since the last update and call
+     * `callback` with it. Only new or posted again posts are transferred, in
+     * pages of up to 20 posts.
+     */
+    syncHistory: {value: function(callback) {
+        var args = {"cursor": this.historyCursor, "count": 20};
+        this.call("get_history", args, function(data) {
+            // TODO: error handling
+            if (data.reset) {
+                // the history cannot be updated incrementally, reload it
+                this.history = [];
+            }
+            var ids = data.posts.map(function(post) { return post.id; });
+            this.history = data.posts.concat(this.history.filter(
+                function(post) { return ids.indexOf(post.id) == -1; }));
+            this.historyCursor = data.cursor;
+            if (data.more) {
+                this.syncHistory(callback);
+            } else {
+                callback(this.history);
+            }
+        }.bind(this));
+    }},
+
     addDoPostHandler: {value: function(handler) {
         this.doPostHandlers.push(handler);
     }},
@@ -366,7 +393,7 @@ ns.PostHistoryScreen = function(ui) {
     $(this.element).addClass("post-history-screen");
     $(this.content).append($('<ul class="select"></ul>'));
 
-    this.ui.call("get_history", {}, function(posts) {
+    this.ui.syncHistory(function(posts) {
         posts.forEach(function(post) {
             var li = $("<li>")
                 .data("post", post)
@@ -57,6 +57,174 @@ ns.Event = function(type, args) {
     this.args = args;
 };
 
+/* ==== msgpack ==== */
+
+/**
+ * Minimal MessagePack (see http://msgpack.org/ ) encoder and decoder for JSON
+ * compatible values. Binary data and extension types are not supported.
+ */
+ns.msgpack = {
+    /**
+     * Encode `value` into an `ArrayBuffer`.
+     */
+    encode: function(value) {
+        var bytes = [];
+        ns.msgpack._encode(value, bytes);
+        return new Uint8Array(bytes).buffer;
+    },
+
+    /**
+     * Decode a value from the `ArrayBuffer` `buffer`.
+     */
+    decode: function(buffer) {
+        var reader = {view: new DataView(buffer), offset: 0};
+        return ns.msgpack._decode(reader);
+    },
+
+    _encode: function(value, bytes) {
+        var i;
+        if (value === null || value === undefined) {
+            bytes.push(0xc0);
+        } else if (value === false) {
+            bytes.push(0xc2);
+        } else if (value === true) {
+            bytes.push(0xc3);
+        } else if (typeof value === "number") {
+            if (value === Math.floor(value) && value >= -0x80000000 &&
+                    value <= 0xffffffff) {
+                if (value >= 0 && value < 0x80) {
+                    bytes.push(value);
+                } else if (value < 0 && value >= -0x20) {
+                    bytes.push(value & 0xff);
+                } else if (value >= 0) {
+                    ns.msgpack._pushUint(bytes, 0xce, value, 4);
+                } else {
+                    ns.msgpack._pushUint(bytes, 0xd2, value >>> 0, 4);
+                }
+            } else {
+                var view = new DataView(new ArrayBuffer(8));
+                view.setFloat64(0, value);
+                bytes.push(0xcb);
+                for (i = 0; i < 8; i++) {
+                    bytes.push(view.getUint8(i));
+                }
+            }
+        } else if (typeof value === "string") {
+            var utf8 = unescape(encodeURIComponent(value));
+            ns.msgpack._pushHeader(bytes, utf8.length, 0xa0, 0xda, 0xdb);
+            for (i = 0; i < utf8.length; i++) {
+                bytes.push(utf8.charCodeAt(i));
+            }
+        } else if (value instanceof Array) {
+            ns.msgpack._pushHeader(bytes, value.length, 0x90, 0xdc, 0xdd);
+            for (i = 0; i < value.length; i++) {
+                ns.msgpack._encode(value[i], bytes);
+            }
+        } else {
+            var keys = Object.keys(value);
+            ns.msgpack._pushHeader(bytes, keys.length, 0x80, 0xde, 0xdf);
+            for (i = 0; i < keys.length; i++) {
+                ns.msgpack._encode(keys[i], bytes);
+                ns.msgpack._encode(value[keys[i]], bytes);
+            }
+        }
+    },
+
+    _pushHeader: function(bytes, length, fix, type16, type32) {
+        // strings use a str8 header for lengths up to 255, other types start
+        // with a 16 bit length beyond the fix range
+        var fixMax = fix === 0xa0 ? 32 : 16;
+        if (length < fixMax) {
+            bytes.push(fix | length);
+        } else if (fix === 0xa0 && length < 0x100) {
+            bytes.push(0xd9, length);
+        } else if (length < 0x10000) {
+            ns.msgpack._pushUint(bytes, type16, length, 2);
+        } else {
+            ns.msgpack._pushUint(bytes, type32, length, 4);
+        }
+    },
+
+    _pushUint: function(bytes, type, value, size) {
+        bytes.push(type);
+        for (var i = size - 1; i >= 0; i--) {
+            bytes.push(Math.floor(value / Math.pow(2, i * 8)) & 0xff);
+        }
+    },
+
+    _decode: function(reader) {
+        var view = reader.view;
+        var type = view.getUint8(reader.offset++);
+        if (type < 0x80) {
+            return type;
+        } else if (type < 0x90) {
+            return ns.msgpack._decodeMap(reader, type & 0x0f);
+        } else if (type < 0xa0) {
+            return ns.msgpack._decodeArray(reader, type & 0x0f);
+        } else if (type < 0xc0) {
+            return ns.msgpack._decodeStr(reader, type & 0x1f);
+        } else if (type >= 0xe0) {
+            return type - 0x100;
+        }
+
+        var read = function(method, size) {
+            var value = view[method](reader.offset);
+            reader.offset += size;
+            return value;
+        };
+        switch (type) {
+        case 0xc0: return null;
+        case 0xc2: return false;
+        case 0xc3: return true;
+        case 0xca: return read("getFloat32", 4);
+        case 0xcb: return read("getFloat64", 8);
+        case 0xcc: return read("getUint8", 1);
+        case 0xcd: return read("getUint16", 2);
+        case 0xce: return read("getUint32", 4);
+        case 0xcf: return read("getUint32", 4) * 0x100000000 +
+            read("getUint32", 4);
+        case 0xd0: return read("getInt8", 1);
+        case 0xd1: return read("getInt16", 2);
+        case 0xd2: return read("getInt32", 4);
+        case 0xd3: return read("getInt32", 4) * 0x100000000 +
+            read("getUint32", 4);
+        case 0xd9: return ns.msgpack._decodeStr(reader, read("getUint8", 1));
+        case 0xda: return ns.msgpack._decodeStr(reader, read("getUint16", 2));
+        case 0xdb: return ns.msgpack._decodeStr(reader, read("getUint32", 4));
+        case 0xdc: return ns.msgpack._decodeArray(reader, read("getUint16", 2));
+        case 0xdd: return ns.msgpack._decodeArray(reader, read("getUint32", 4));
+        case 0xde: return ns.msgpack._decodeMap(reader, read("getUint16", 2));
+        case 0xdf: return ns.msgpack._decodeMap(reader, read("getUint32", 4));
+        default: throw new Error("msgpack_type_unsupported");
+        }
+    },
+
+    _decodeStr: function(reader, length) {
+        var utf8 = "";
+        for (var i = 0; i < length; i++) {
+            utf8 += String.fromCharCode(reader.view.getUint8(reader.offset++));
+        }
+        return decodeURIComponent(escape(utf8));
+    },
+
+    _decodeArray: function(reader, length) {
+        var array = [];
+        for (var i = 0; i < length; i++) {
+            array.push(ns.msgpack._decode(reader));
+        }
+        return array;
+    },
+
+    _decodeMap: function(reader, length) {
+        var map = {};
+        for (var i = 0; i < length; i++) {
+            var key = ns.msgpack._decode(reader);
+            map[key] = ns.msgpack._decode(reader);
+        }
+        return map;
+    }
+};
+
 /* ==== */
 
 ns.cloneChildNodes = function(node) {
@@ -14,10 +14,22 @@ ns.Ui = function(bricks) {
     this.bricks = {};
     this.postElementTypes = {};
     this.msgHandlers = {};
+    this.callbacks = {};
+    this.topics = [];
+    // session to resume on reconnect and sequence number of the last message
+    // received
+    this.session = null;
+    this.seq = 0;
+    this.nextId = 1;
+    // message encoding, "json" or "msgpack". MessagePack is opt-in, e.g. by
+    // opening the page with the query argument encoding=msgpack.
+    this.encoding = /[?&]encoding=msgpack(&|$)/.test(location.search) ?
+        "msgpack" : "json";
     this.socket = null;
     this.connectionState = "closed";
 
     this.msgHandlers["posted"] = this.eventMessage.bind(this);
+    this.msgHandlers["session"] = this._sessionMessage.bind(this);
 };
 
 ns.Ui.prototype = Object.create(wall.util.EventTarget.prototype, {
@@ -26,18 +38,30 @@ ns.Ui.prototype = Object.create(wall.util.EventTarget.prototype, {
     }},
 
     send: {value: function(msg) {
-        this.socket.send(JSON.stringify(msg));
+        if (this.socket.protocol === "msgpack") {
+            this.socket.send(wall.util.msgpack.encode(msg));
+        } else {
+            this.socket.send(JSON.stringify(msg));
+        }
+    }},
+
+    /**
+     * Subscribe to `topic`, also after reconnecting. Clients are subscribed to
+     * `posted` by default.
+     */
+    subscribe: {value: function(topic) {
+        this.topics.push(topic);
+        if (this.connectionState === "open") {
+            this.call("subscribe", {"topic": topic});
+        }
     }},
 
     call: {value: function(method, args, callback) {
-        callback = callback || null;
-        this.msgHandlers[method] = function(msg) {
-            delete this.msgHandlers[method];
-            if (callback) {
-                callback(msg.data);
-            }
-        }.bind(this);
-        this.send({"type": method, "data": args});
+        // the request id matches the response, even if responses to multiple
+        // calls arrive out of order
+        var id = this.nextId++;
+        this.callbacks[id] = callback || null;
+        this.send({"type": method, "data": args, "id": id});
     }},
 
     loadBricks: {value: function(bricks, type) {
@@ -66,7 +90,14 @@ ns.Ui.prototype = Object.create(wall.util.EventTarget.prototype, {
 
     _connect: {value: function() {
         console.log("connecting...");
-        this.socket = new WebSocket("ws://" + location.host + "/api/socket");
+        var url = "ws://" + location.host + "/api/socket?batch=1";
+        if (this.session) {
+            url += "&session=" + this.session + "&seq=" + this.seq;
+        }
+        // the server selects the message encoding from the offered subprotocols
+        this.socket = new WebSocket(url,
+            this.encoding === "msgpack" ? ["msgpack", "json"] : ["json"]);
+        this.socket.binaryType = "arraybuffer";
         this.socket.addEventListener("open",    $.proxy(this._opened,   this));
         this.socket.addEventListener("close",   $.proxy(this._closed,   this));
         this.socket.addEventListener("message", $.proxy(this._received, this));
@@ -76,6 +107,9 @@ ns.Ui.prototype = Object.create(wall.util.EventTarget.prototype, {
     _opened: {value: function(event) {
         console.log("connected");
         this.connectionState = "open";
+        this.topics.forEach(function(topic) {
+            this.call("subscribe", {"topic": topic});
+        }, this);
     }},
 
     _closed: {value: function(event) {
@@ -88,11 +122,36 @@ ns.Ui.prototype = Object.create(wall.util.EventTarget.prototype, {
             // unreachable
             throw new Error();
         }
-        setTimeout(this._connect.bind(this), 5000);
+        // spread out reconnects of many clients after a network outage
+        setTimeout(this._connect.bind(this), 1000 + Math.random() * 4000);
     }},
 
     _received: {value: function(event) {
-        var msg = JSON.parse(event.data);
+        var msgs = event.data instanceof ArrayBuffer ?
+            wall.util.msgpack.decode(event.data) : JSON.parse(event.data);
+        if (!(msgs instanceof Array)) {
+            msgs = [msgs];
+        }
+        msgs.forEach(this._handleMessage, this);
+    }},
+
+    _sessionMessage: {value: function(msg) {
+        this.session = msg.data.id;
+        if (!msg.data.resumed) {
+            this.seq = 0;
+        }
+    }},
+
+    _handleMessage: {value: function(msg) {
+        if (msg.seq) {
+            this.seq = msg.seq;
+        }
+        if (msg.id in this.callbacks) {
+            var callback = this.callbacks[msg.id];
+            delete this.callbacks[msg.id];
+            callback && callback(msg.data);
+            return;
+        }
         this.msgHandlers[msg.type] && this.msgHandlers[msg.type](msg);
     }}
 });
@@ -0,0 +1,167 @@
+# Wall
+
+# Python forward compatibility
+from __future__ import (division, absolute_import, print_function,
+    unicode_literals)
+
+import re
+from bisect import bisect_left, insort
+from heapq import nlargest
+
+_word_pattern = re.compile(r'\w+', re.UNICODE)
+
+class SearchIndex(object):
+    """
+    In-memory full-text index of documents, given by their id and text. The
+    words of a query match all words they are a prefix of.
+
+    Every document has a `key` by which results are ordered, highest first.
+
+    Internally, an inverted index maps every word to the documents which contain
+    it. Words are kept sorted, so that the words matching a prefix are found by
+    binary search.
+    """
+
+    def __init__(self):
+        self._postings = {}
+        self._words = []
+        self._docs = {}
+        self._keys = {}
+
+    def add(self, id, text, key=0):
+        """
+        Add the document `id` with the given `text` and `key`. An existing
+        document with the same `id` is replaced.
+        """
+        for word in self._add(id, text, key):
+            insort(self._words, word)
+
+    def add_all(self, documents):
+        """
+        Add all `documents`, given as iterable of `(id, text, key)` tuples (see
+        `add`). Considerably faster than adding the documents one by one, e.g.
+        when building the index.
+        """
+        for id, text, key in documents:
+            self._add(id, text, key)
+        self._words = sorted(self._postings)
+
+    def _add(self, id, text, key):
+        # add the document without updating _words, return the new words
+        self.remove(id)
+        words = set(tokenize(text))
+        self._docs[id] = words
+        self._keys[id] = key
+        new_words = []
+        for word in words:
+            ids = self._postings.get(word)
+            if ids is None:
+                ids = self._postings[word] = set()
+                new_words.append(word)
+            ids.add(id)
+        return new_words
+
+    def remove(self, id):
+        """
+        Remove the document `id`, if it is indexed.
+        """
+        words = self._docs.pop(id, None)
+        if words is None:
+            return
+        del self._keys[id]
+        for word in words:
+            ids = self._postings[word]
+            ids.discard(id)
+            if not ids:
+                del self._postings[word]
+                # during add_all, new words are not in _words yet
+                i = bisect_left(self._words, word)
+                if i < len(self._words) and self._words[i] == word:
+                    del self._words[i]
+
+    def search(self, query, count=None):
+        """
+        Return the ids of the documents, which match all words of the `query`,
+        ordered by their key, highest first. At most `count` ids are returned,
+        if given.
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        matches = [(t, self._match(t)) for t in terms]
+        # collect the candidates of the most selective term, then filter them by
+        # the other terms
+        matches.sort(key=lambda m: sum(len(self._postings[w]) for w in m[1]))
+        ids = set().union(*(self._postings[w] for w in matches[0][1]))
+        for term, words in matches[1:]:
+            ids = [id for id in ids
+                   if any(w.startswith(term) for w in self._docs[id])]
+        if count is None:
+            return sorted(ids, key=self._keys.get, reverse=True)
+        return nlargest(count, ids, key=self._keys.get)
+
+    def _match(self, prefix):
+        # words starting with prefix
+        start = bisect_left(self._words, prefix)
+        end = bisect_left(self._words, prefix + '\uffff')
+        return self._words[start:end]
+
+    def __contains__(self, id):
+        return id in self._docs
+
+    def __len__(self):
+        return len(self._docs)
+
+def tokenize(text):
+    """
+    Split `text` into lower case words.
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    return _word_pattern.findall(text.lower())
+
+# ==== Tests ====
+
+from unittest import TestCase
+
+class SearchIndexTest(TestCase):
+    def setUp(self):
+        self.index = SearchIndex()
+        self.index.add('ship:0', 'Starfury, Babylon 5', 3)
+        self.index.add('ship:1', 'White Star', 2)
+        self.index.add('ship:2', 'Babylon 4 Station', 1)
+
+    def test_search(self):
+        self.assertEqual(['ship:0', 'ship:2'], self.index.search('babylon'))
+        self.assertEqual(['ship:2'], self.index.search('Babylon station'))
+        self.assertEqual([], self.index.search('babylon white'))
+        self.assertEqual([], self.index.search(''))
+
+    def test_search_prefix(self):
+        self.assertEqual(['ship:0', 'ship:1', 'ship:2'],
+            self.index.search('st'))
+        self.assertEqual(['ship:0', 'ship:1'], self.index.search('st', 2))
+        self.assertEqual(['ship:2'], self.index.search('stat bab'))
+
+    def test_add_replace(self):
+        self.index.add('ship:0', 'Whitestar', 4)
+        self.assertEqual(['ship:1'], self.index.search('star'))
+        self.assertEqual(['ship:0', 'ship:1'], self.index.search('white'))
+
+    def test_remove(self):
+        self.index.remove('ship:1')
+        self.index.remove('foo')
+        self.assertEqual(['ship:0', 'ship:2'], self.index.search('st'))
+        self.assertNotIn('white', self.index._words)
+        self.assertEqual(2, len(self.index))
+
+    def test_add_all(self):
+        self.index.add_all([('ship:3', 'Whitestar', 4),
+                            ('ship:4', 'Narn cruiser', 5),
+                            ('ship:4', 'Vorlon ship', 5),
+                            ('ship:1', 'Starfury', 2)])
+        self.assertEqual(['ship:0', 'ship:1', 'ship:2'], self.index.search('st'))
+        self.assertEqual(['ship:3'], self.index.search('white'))
+        self.assertEqual(['ship:4'], self.index.search('vor'))
+        self.assertEqual([], self.index.search('narn'))
+        self.assertEqual(sorted(self.index._postings), self.index._words)
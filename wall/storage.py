@@ -0,0 +1,962 @@
+# Wall
+
+# Python forward compatibility
+from __future__ import (division, absolute_import, print_function,
+    unicode_literals)
+
+import sys
+import os
+import sqlite3
+from bisect import bisect
+from hashlib import md5
+from itertools import cycle
+from collections import OrderedDict
+from contextlib import contextmanager
+from tornado.concurrent import Future
+from tornado.gen import coroutine, Return
+from redis import StrictRedis
+from redis.exceptions import ResponseError
+from wall.util import AsyncRedis
+
+def open_engine(storage, db=0, path=None, shards=None):
+    """
+    Open the storage engine `storage`, which is either `redis`, `memory` or
+    `sqlite`. `db` is the Redis database index and `path` the path of the
+    SQLite database file.
+
+    For `redis`, keys may be distributed across multiple Redis servers.
+    `shards` is a list of shards, each one given as a list of servers, where the
+    first one is the primary and the others are read-only replicas (see
+    `ShardedRedis`). A server is given as `<host>:<port>[/<db>]`, by default
+    replicas use the database of their primary.
+
+    Returns a synchronous client with the interface of `StrictRedis` and an
+    asynchronous client with the interface of `AsyncRedis`.
+    """
+    if storage == 'redis':
+        if not shards:
+            return StrictRedis(db=db), AsyncRedis(db=db)
+        nodes = []
+        for shard in shards:
+            primary = parse_server(shard[0], db)
+            # replicas default to the database of the primary
+            nodes.append([primary] +
+                [parse_server(n, primary[2]) for n in shard[1:]])
+        names = [shard[0] for shard in shards]
+        return (
+            ShardedRedis([[StrictRedis(*n) for n in s] for s in nodes], names),
+            AsyncShardedRedis([[AsyncRedis(*n) for n in s] for s in nodes],
+                names))
+    elif storage == 'memory':
+        engine = MemoryEngine()
+    elif storage == 'sqlite':
+        engine = SQLiteEngine(path)
+    else:
+        raise ValueError('storage')
+    return engine, AsyncEngine(engine)
+
+class Engine(object):
+    """
+    Storage engine, which keeps data in-process instead of in a Redis server.
+
+    The interface is compatible to the one of `StrictRedis`, restricted to the
+    data types and commands used by Wall. Thus, a storage engine may be used in
+    place of a Redis client (e.g. by `ObjectRedis`). Supported are strings
+    (`get`, `set`, `mget`), hashes (`hget`, `hmget`, `hgetall`, `hset`, `hmset`,
+    `hdel`), sets (`sadd`, `srem`, `sismember`, `smembers`, `scard`,
+    `sscan_iter`), sorted sets (`zadd`, `zrem`, `zcard`, `zrange`, `zrevrange`,
+    `zrangebyscore`) and generic commands (`type`, `exists`, `delete`,
+    `flushdb`, `pipeline`). `set` supports the option `nx`.
+
+    Additionally, `delifeq(name, value)` deletes the string `name` only if it
+    holds `value` and returns the number of deleted keys, like `DELIFEQ` of
+    Valkey (emulated by a Lua script for Redis, see `AsyncRedis`).
+
+    Subclasses must implement all commands except `mget`, `hmget`, `exists`,
+    `sscan_iter`, `delifeq` and `pipeline`. Commands executed within
+    `transaction` must be applied atomically.
+    """
+
+    def pipeline(self, transaction=True):
+        return EnginePipeline(self)
+
+    @contextmanager
+    def transaction(self):
+        yield
+
+    def mget(self, keys, *args):
+        return [self.get(k) for k in _list_or_args(keys, args)]
+
+    def hmget(self, name, keys, *args):
+        hash = self.hgetall(name)
+        return [hash.get(encode(k)) for k in _list_or_args(keys, args)]
+
+    def exists(self, name):
+        return self.type(name) != 'none'
+
+    def delifeq(self, name, value):
+        # atomic, as commands are executed one after another in-process
+        if self.get(name) != encode(value):
+            return 0
+        return self.delete(name)
+
+    def sscan_iter(self, name, match=None, count=None):
+        # members are cheap to iterate in-process, so count is ignored
+        for member in sorted(self.smembers(name)):
+            yield member
+
+class EnginePipeline(object):
+    """
+    Pipeline of a storage `Engine`, with the interface of the pipeline of
+    `StrictRedis`. Commands are buffered and executed in a single transaction by
+    `execute`.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.commands = []
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        replies = []
+        with self.engine.transaction():
+            for method, args, kwargs in commands:
+                try:
+                    replies.append(method(*args, **kwargs))
+                except ResponseError as e:
+                    replies.append(e)
+        for reply in replies:
+            if isinstance(reply, ResponseError):
+                raise reply
+        return replies
+
+    def __getattr__(self, name):
+        method = getattr(self.engine, name)
+        def command(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return command
+
+class MemoryEngine(Engine):
+    """
+    Storage engine, which keeps all data in memory. Data is lost when the
+    process exits.
+    """
+
+    def __init__(self):
+        self._data = {}
+
+    def flushdb(self):
+        self._data = {}
+        return True
+
+    def type(self, name):
+        return self._data.get(encode(name), ('none', None))[0]
+
+    def delete(self, *names):
+        count = 0
+        for name in names:
+            if self._data.pop(encode(name), None):
+                count += 1
+        return count
+
+    def get(self, name):
+        return self._get(name, 'string')
+
+    def set(self, name, value, nx=False):
+        if nx and encode(name) in self._data:
+            return None
+        self._data[encode(name)] = ('string', encode(value))
+        return True
+
+    def hget(self, name, key):
+        return self._get(name, 'hash', {}).get(encode(key))
+
+    def hgetall(self, name):
+        return dict(self._get(name, 'hash', {}))
+
+    def hset(self, name, key, value):
+        hash = self._get(name, 'hash', create=True)
+        key = encode(key)
+        new = key not in hash
+        hash[key] = encode(value)
+        return int(new)
+
+    def hmset(self, name, mapping):
+        hash = self._get(name, 'hash', create=True)
+        for key, value in mapping.items():
+            hash[encode(key)] = encode(value)
+        return True
+
+    def hdel(self, name, *keys):
+        return self._remove(name, 'hash', keys)
+
+    def sadd(self, name, *values):
+        members = self._get(name, 'set', create=True)
+        count = len(members)
+        members.update(encode(v) for v in values)
+        return len(members) - count
+
+    def srem(self, name, *values):
+        return self._remove(name, 'set', values)
+
+    def sismember(self, name, value):
+        return encode(value) in self._get(name, 'set', ())
+
+    def smembers(self, name):
+        return set(self._get(name, 'set', ()))
+
+    def scard(self, name):
+        return len(self._get(name, 'set', ()))
+
+    def zadd(self, name, *args):
+        scores = self._get(name, 'zset', create=True)
+        count = 0
+        for score, member in zip(args[::2], args[1::2]):
+            member = encode(member)
+            if member not in scores:
+                count += 1
+            scores[member] = float(score)
+        return count
+
+    def zrem(self, name, *values):
+        return self._remove(name, 'zset', values)
+
+    def zcard(self, name):
+        return len(self._get(name, 'zset', ()))
+
+    def zrange(self, name, start, end):
+        return _slice(self._sorted(name), start, end)
+
+    def zrevrange(self, name, start, end):
+        return _slice(list(reversed(self._sorted(name))), start, end)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None):
+        scores = self._get(name, 'zset', {})
+        min, max = float(min), float(max)
+        members = [m for m in self._sorted(name) if min <= scores[m] <= max]
+        if start is not None and num is not None:
+            members = members[start:start + num]
+        return members
+
+    def _get(self, name, type, default=None, create=False):
+        name = encode(name)
+        try:
+            item_type, value = self._data[name]
+        except KeyError:
+            if not create:
+                return default
+            item_type, value = self._data[name] = (type,
+                {'hash': {}, 'set': set(), 'zset': {}}[type])
+        if item_type != type:
+            raise _wrong_type_error()
+        return value
+
+    def _remove(self, name, type, items):
+        values = self._get(name, type, {})
+        count = 0
+        for item in items:
+            item = encode(item)
+            if item in values:
+                values.remove(item) if type == 'set' else values.pop(item)
+                count += 1
+        if not values:
+            self._data.pop(encode(name), None)
+        return count
+
+    def _sorted(self, name):
+        scores = self._get(name, 'zset', {})
+        return sorted(scores, key=lambda m: (scores[m], m))
+
+class SQLiteEngine(Engine):
+    """
+    Storage engine, which keeps all data in the SQLite database at `path`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.text_factory = bytes
+        self._transaction = False
+        # with write-ahead logging, a commit does not need to wait for the data
+        # to be synced to disk
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.execute('PRAGMA synchronous = NORMAL')
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS keys (
+                key BLOB PRIMARY KEY, type TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS strings (
+                key BLOB PRIMARY KEY, value BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS hashes (
+                key BLOB, field BLOB, value BLOB NOT NULL,
+                PRIMARY KEY (key, field));
+            CREATE TABLE IF NOT EXISTS sets (
+                key BLOB, member BLOB, PRIMARY KEY (key, member));
+            CREATE TABLE IF NOT EXISTS zsets (
+                key BLOB, member BLOB, score REAL NOT NULL,
+                PRIMARY KEY (key, member));
+            CREATE INDEX IF NOT EXISTS zsets_score ON zsets (key, score, member);
+        """)
+
+    @contextmanager
+    def transaction(self):
+        self._transaction = True
+        try:
+            yield
+        finally:
+            self._transaction = False
+            self._conn.commit()
+
+    def flushdb(self):
+        for table in ['keys', 'strings', 'hashes', 'sets', 'zsets']:
+            self._conn.execute('DELETE FROM {}'.format(table))
+        self._commit()
+        return True
+
+    def type(self, name):
+        row = self._query('SELECT type FROM keys WHERE key = ?', name)
+        return row[0][0] if row else 'none'
+
+    def delete(self, *names):
+        count = 0
+        for name in names:
+            name = encode(name)
+            type = self.type(name)
+            if type != 'none':
+                self._delete(name, type)
+                count += 1
+        self._commit()
+        return count
+
+    def get(self, name):
+        self._check(name, 'string')
+        row = self._query('SELECT value FROM strings WHERE key = ?', name)
+        return row[0][0] if row else None
+
+    def set(self, name, value, nx=False):
+        if nx and self.exists(name):
+            return None
+        self.delete(name)
+        self._create(name, 'string')
+        self._execute('INSERT INTO strings VALUES (?, ?)', name, encode(value))
+        self._commit()
+        return True
+
+    def hget(self, name, key):
+        self._check(name, 'hash')
+        row = self._query(
+            'SELECT value FROM hashes WHERE key = ? AND field = ?', name,
+            encode(key))
+        return row[0][0] if row else None
+
+    def hgetall(self, name):
+        self._check(name, 'hash')
+        return dict(
+            self._query('SELECT field, value FROM hashes WHERE key = ?', name))
+
+    def hset(self, name, key, value):
+        new = self.hget(name, key) is None
+        self._create(name, 'hash')
+        self._execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)', name,
+            encode(key), encode(value))
+        self._commit()
+        return int(new)
+
+    def hmset(self, name, mapping):
+        self._check(name, 'hash')
+        self._create(name, 'hash')
+        for key, value in mapping.items():
+            self._execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)',
+                name, encode(key), encode(value))
+        self._commit()
+        return True
+
+    def hdel(self, name, *keys):
+        self._check(name, 'hash')
+        return self._remove('hashes', 'field', name, keys)
+
+    def sadd(self, name, *values):
+        self._check(name, 'set')
+        self._create(name, 'set')
+        count = 0
+        for value in values:
+            count += self._execute('INSERT OR IGNORE INTO sets VALUES (?, ?)',
+                name, encode(value)).rowcount
+        self._commit()
+        return count
+
+    def srem(self, name, *values):
+        self._check(name, 'set')
+        return self._remove('sets', 'member', name, values)
+
+    def sismember(self, name, value):
+        self._check(name, 'set')
+        return bool(self._query(
+            'SELECT 1 FROM sets WHERE key = ? AND member = ?', name,
+            encode(value)))
+
+    def smembers(self, name):
+        self._check(name, 'set')
+        return set(r[0] for r in
+            self._query('SELECT member FROM sets WHERE key = ?', name))
+
+    def scard(self, name):
+        self._check(name, 'set')
+        return self._query('SELECT COUNT(*) FROM sets WHERE key = ?', name)[0][0]
+
+    def zadd(self, name, *args):
+        self._check(name, 'zset')
+        self._create(name, 'zset')
+        count = 0
+        for score, member in zip(args[::2], args[1::2]):
+            count += self._execute(
+                'INSERT OR IGNORE INTO zsets VALUES (?, ?, ?)', name,
+                encode(member), float(score)).rowcount
+            self._execute(
+                'UPDATE zsets SET score = ? WHERE key = ? AND member = ?',
+                float(score), name, encode(member))
+        self._commit()
+        return count
+
+    def zrem(self, name, *values):
+        self._check(name, 'zset')
+        return self._remove('zsets', 'member', name, values)
+
+    def zcard(self, name):
+        self._check(name, 'zset')
+        return self._query('SELECT COUNT(*) FROM zsets WHERE key = ?',
+            name)[0][0]
+
+    def zrange(self, name, start, end):
+        return self._zrange(name, start, end, 'ASC')
+
+    def zrevrange(self, name, start, end):
+        return self._zrange(name, start, end, 'DESC')
+
+    def zrangebyscore(self, name, min, max, start=None, num=None):
+        self._check(name, 'zset')
+        sql = """SELECT member FROM zsets
+            WHERE key = ? AND score >= ? AND score <= ?
+            ORDER BY score, member"""
+        args = [name, float(min), float(max)]
+        if start is not None and num is not None:
+            sql += ' LIMIT ? OFFSET ?'
+            args.extend([num, start])
+        return [r[0] for r in self._query(sql, *args)]
+
+    def _zrange(self, name, start, end, order):
+        self._check(name, 'zset')
+        if start < 0 or end < 0:
+            count = self.zcard(name)
+            start = start + count if start < 0 else start
+            end = end + count if end < 0 else end
+        start = max(start, 0)
+        if end < start:
+            return []
+        sql = """SELECT member FROM zsets WHERE key = ?
+            ORDER BY score {0}, member {0} LIMIT ? OFFSET ?""".format(order)
+        return [r[0] for r in self._query(sql, name, end - start + 1, start)]
+
+    def _check(self, name, type):
+        item_type = self.type(name)
+        if item_type not in ['none', type]:
+            raise _wrong_type_error()
+
+    def _create(self, name, type):
+        self._execute('INSERT OR IGNORE INTO keys VALUES (?, ?)', name, type)
+
+    def _delete(self, name, type):
+        table = {'string': 'strings', 'hash': 'hashes', 'set': 'sets',
+                 'zset': 'zsets'}[type]
+        self._execute('DELETE FROM {} WHERE key = ?'.format(table), name)
+        self._execute('DELETE FROM keys WHERE key = ?', name)
+
+    def _remove(self, table, column, name, items):
+        count = 0
+        for item in items:
+            count += self._execute(
+                'DELETE FROM {} WHERE key = ? AND {} = ?'.format(table, column),
+                name, encode(item)).rowcount
+        if not self._query('SELECT 1 FROM {} WHERE key = ? LIMIT 1'.format(
+            table), name):
+            self._execute('DELETE FROM keys WHERE key = ?', name)
+        self._commit()
+        return count
+
+    def _execute(self, sql, *args):
+        return self._conn.execute(sql, [_param(a) for a in args])
+
+    def _query(self, sql, *args):
+        return self._execute(sql, *args).fetchall()
+
+    def _commit(self):
+        if not self._transaction:
+            self._conn.commit()
+
+class AsyncEngine(object):
+    """
+    Asynchronous facade of a storage `Engine`, with the interface of
+    `AsyncRedis`. As a storage engine does not wait for network I/O, commands
+    are executed immediately and return resolved `Future`s.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def pipeline(self, transaction=True):
+        return AsyncEnginePipeline(self.engine.pipeline(transaction))
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        method = getattr(self.engine, name)
+        def command(*args, **kwargs):
+            return _future(method, *args, **kwargs)
+        return command
+
+class AsyncEnginePipeline(object):
+    """
+    Asynchronous facade of an `EnginePipeline`, with the interface of
+    `AsyncPipeline`.
+    """
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def execute(self):
+        return _future(self.pipe.execute)
+
+    def __getattr__(self, name):
+        method = getattr(self.pipe, name)
+        def command(*args, **kwargs):
+            method(*args, **kwargs)
+            return self
+        return command
+
+READ_COMMANDS = set([
+    'type', 'exists', 'get', 'mget', 'hget', 'hmget', 'hgetall', 'sismember',
+    'smembers', 'scard', 'sscan_iter', 'zcard', 'zrange', 'zrevrange',
+    'zrangebyscore'])
+WRITE_COMMANDS = set([
+    'delete', 'delifeq', 'set', 'hset', 'hmset', 'hdel', 'sadd', 'srem', 'zadd', 'zrem'])
+
+class ShardedRedis(object):
+    """
+    Redis client, which distributes keys across multiple Redis servers by
+    consistent hashing, with the interface of `StrictRedis`. Supported are the
+    commands of storage engines (see `Engine`).
+
+    Every shard is given as list of clients, where the first one is the primary
+    and the others are read-only replicas. Writes are sent to the primary. Reads
+    are distributed round-robin across the replicas, if there are any. Note that
+    replicas may lag slightly behind the primary.
+
+    A pipeline is split into one pipeline per server, so commands are executed
+    atomically per server, not across servers. Reads of a pipeline go to the
+    replicas only if it consists solely of reads.
+
+    Attributes:
+
+     * `shards`: list of shards, each one a list of clients (primary first).
+       Read-Only.
+     * `names`: names of the shards, which determine the distribution of the
+       keys. Adding a shard only moves the keys which are then stored on the new
+       shard. Read-Only.
+    """
+
+    vnodes = 64
+
+    def __init__(self, shards, names=None):
+        self.shards = shards
+        self.names = names or [unicode(i) for i in xrange(len(shards))]
+        self._ring = sorted(
+            (_hash('{}#{}'.format(name, i)), shard)
+            for shard, name in enumerate(self.names)
+            for i in xrange(self.vnodes))
+        self._points = [p for p, shard in self._ring]
+        self._replicas = [cycle(s[1:]) if len(s) > 1 else None
+                          for s in shards]
+
+    def shard(self, key):
+        """
+        Return the index of the shard which stores `key`.
+        """
+        i = bisect(self._points, _hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+    def node(self, shard, read=False):
+        """
+        Return the client to use for the `shard`. If `read` is set, a replica is
+        returned, if there is one.
+        """
+        replicas = self._replicas[shard]
+        return next(replicas) if read and replicas else self.shards[shard][0]
+
+    def pipeline(self, transaction=True):
+        return ShardedPipeline(self, transaction)
+
+    def flushdb(self):
+        for shard in self.shards:
+            shard[0].flushdb()
+        return True
+
+    def __getattr__(self, name):
+        if name not in READ_COMMANDS | WRITE_COMMANDS:
+            raise AttributeError(name)
+        def command(*args, **kwargs):
+            if name in ['mget', 'delete']:
+                # keys may be stored on different shards
+                return self._first(
+                    getattr(self.pipeline(False), name)(*args).execute())
+            node = self.node(self.shard(args[0]), name in READ_COMMANDS)
+            return getattr(node, name)(*args, **kwargs)
+        return command
+
+    def _first(self, replies):
+        return replies[0]
+
+class AsyncShardedRedis(ShardedRedis):
+    """
+    Asynchronous variant of `ShardedRedis`, with the interface of `AsyncRedis`.
+    Every shard is given as list of `AsyncRedis` clients.
+    """
+
+    def pipeline(self, transaction=True):
+        return AsyncShardedPipeline(self, transaction)
+
+    def close(self):
+        for shard in self.shards:
+            for node in shard:
+                node.close()
+
+    @coroutine
+    def _first(self, replies):
+        replies = yield replies
+        raise Return(replies[0])
+
+class ShardedPipeline(object):
+    """
+    Pipeline of a `ShardedRedis` client.
+    """
+
+    def __init__(self, redis, transaction):
+        self.redis = redis
+        self.transaction = transaction
+        self.commands = []
+
+    def execute(self):
+        groups, plan = self._prepare()
+        replies = {}
+        error = None
+        for key, pipe in groups.items():
+            try:
+                replies[key] = pipe.execute()
+            except ResponseError as e:
+                error = error or e
+        if error:
+            raise error
+        return self._combine(plan, replies)
+
+    def _prepare(self):
+        # split the commands into one pipeline per server. Returns the pipelines
+        # and for every command the positions of its replies and a function to
+        # combine them.
+        commands, self.commands = self.commands, []
+        read = all(name in READ_COMMANDS for name, args, kwargs in commands)
+        nodes = {}
+        groups = OrderedDict()
+        counts = {}
+        plan = []
+        for name, args, kwargs in commands:
+            if name == 'mget':
+                parts = [('get', (k,), {})
+                         for k in _list_or_args(args[0], args[1:])]
+                combine = list
+            elif name == 'delete':
+                parts = [('delete', (k,), {}) for k in args]
+                combine = sum
+            else:
+                parts = [(name, args, kwargs)]
+                combine = lambda replies: replies[0]
+
+            refs = []
+            for name, args, kwargs in parts:
+                shard = self.redis.shard(args[0])
+                if shard not in nodes:
+                    nodes[shard] = self.redis.node(shard, read)
+                key = id(nodes[shard])
+                if key not in groups:
+                    groups[key] = nodes[shard].pipeline(self.transaction)
+                    counts[key] = 0
+                getattr(groups[key], name)(*args, **kwargs)
+                refs.append((key, counts[key]))
+                counts[key] += 1
+            plan.append((refs, combine))
+        return groups, plan
+
+    def _combine(self, plan, replies):
+        return [combine([replies[key][i] for key, i in refs])
+                for refs, combine in plan]
+
+    def __getattr__(self, name):
+        if name not in READ_COMMANDS | WRITE_COMMANDS:
+            raise AttributeError(name)
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return command
+
+class AsyncShardedPipeline(ShardedPipeline):
+    """
+    Pipeline of an `AsyncShardedRedis` client. The pipelines of the servers are
+    executed concurrently.
+    """
+
+    @coroutine
+    def execute(self):
+        groups, plan = self._prepare()
+        futures = [(key, pipe.execute()) for key, pipe in groups.items()]
+        replies = {}
+        error = None
+        for key, future in futures:
+            try:
+                replies[key] = yield future
+            except ResponseError as e:
+                error = error or e
+        if error:
+            raise error
+        raise Return(self._combine(plan, replies))
+
+def parse_server(server, db=0):
+    """
+    Parse a Redis `server`, given as `<host>:<port>[/<db>]`. If no database
+    index is given, `db` is used.
+
+    Returns a tuple of host, port and database index.
+    """
+    try:
+        address, _, index = server.partition('/')
+        host, port = address.split(':')
+        return host, int(port), int(index) if index else db
+    except ValueError:
+        raise ValueError('server')
+
+def encode(value):
+    """
+    Encode `value` for storage, the same way as redis-py does.
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value)
+    return unicode(value).encode('utf-8')
+
+def _param(value):
+    return value if isinstance(value, (int, long, float)) else encode(value)
+
+def _list_or_args(keys, args):
+    if isinstance(keys, (bytes, unicode)):
+        keys = [keys]
+    return list(keys) + list(args)
+
+def _hash(key):
+    return int(md5(encode(key)).hexdigest()[:8], 16)
+
+def _slice(items, start, end):
+    # slice with the (inclusive) range semantics of Redis
+    count = len(items)
+    start = start + count if start < 0 else start
+    end = end + count if end < 0 else end
+    return items[max(start, 0):end + 1]
+
+def _wrong_type_error():
+    return ResponseError('WRONGTYPE Operation against a key holding the wrong '
+        'kind of value')
+
+def _future(function, *args, **kwargs):
+    future = Future()
+    try:
+        future.set_result(function(*args, **kwargs))
+    except Exception:
+        future.set_exc_info(sys.exc_info())
+    return future
+
+# ==== Tests ====
+
+from unittest import TestCase
+from shutil import rmtree
+from tempfile import mkdtemp
+from tornado.testing import AsyncTestCase, gen_test
+
+class EngineTest(object):
+    """
+    Mixin for storage engine tests. The engine to test must be set as `r` by
+    the subclass during `setUp`.
+    """
+
+    def test_string(self):
+        self.assertTrue(self.r.set('ship:0', 'starfury'))
+        self.assertEqual('starfury', self.r.get('ship:0'))
+        self.assertEqual(['starfury', None], self.r.mget(['ship:0', 'foo']))
+        self.assertEqual('string', self.r.type('ship:0'))
+        self.assertIsNone(self.r.get('foo'))
+
+    def test_hash(self):
+        self.assertEqual(1, self.r.hset('ship:0', 'type', 'starfury'))
+        self.assertEqual(0, self.r.hset('ship:0', 'type', 'whitestar'))
+        self.r.hmset('ship:0', {'id': 'ship:0', 'crew': 2})
+        self.assertEqual({'id': 'ship:0', 'type': 'whitestar', 'crew': '2'},
+            self.r.hgetall('ship:0'))
+        self.assertEqual(['2', None], self.r.hmget('ship:0', 'crew', 'foo'))
+        self.assertEqual(1, self.r.hdel('ship:0', 'crew'))
+        self.assertIsNone(self.r.hget('ship:0', 'crew'))
+        self.assertEqual({}, self.r.hgetall('foo'))
+
+    def test_set(self):
+        self.assertEqual(2, self.r.sadd('ships', 'ship:0', 'ship:1'))
+        self.assertEqual(0, self.r.sadd('ships', 'ship:0'))
+        self.assertTrue(self.r.sismember('ships', 'ship:0'))
+        self.assertEqual(set(['ship:0', 'ship:1']), self.r.smembers('ships'))
+        self.assertEqual(set(['ship:0', 'ship:1']),
+            set(self.r.sscan_iter('ships', count=1)))
+        self.assertEqual(1, self.r.srem('ships', 'ship:0', 'foo'))
+        self.assertEqual(1, self.r.scard('ships'))
+        self.r.srem('ships', 'ship:1')
+        self.assertFalse(self.r.exists('ships'))
+
+    def test_sorted_set(self):
+        self.assertEqual(3, self.r.zadd('ships', 2, 'b', 1, 'a', 3, 'c'))
+        self.assertEqual(0, self.r.zadd('ships', 0, 'c'))
+        self.assertEqual(['c', 'a', 'b'], self.r.zrange('ships', 0, -1))
+        self.assertEqual(['a', 'b'], self.r.zrange('ships', 1, 5))
+        self.assertEqual(['b', 'a'], self.r.zrevrange('ships', 0, 1))
+        self.assertEqual(['a', 'b'],
+            self.r.zrangebyscore('ships', 1, '+inf'))
+        self.assertEqual(['c'], self.r.zrangebyscore('ships', '-inf', 2, 0, 1))
+        self.assertEqual(1, self.r.zrem('ships', 'a'))
+        self.assertEqual(2, self.r.zcard('ships'))
+
+    def test_set_nx(self):
+        self.assertTrue(self.r.set('ship:0', 'starfury', nx=True))
+        self.assertIsNone(self.r.set('ship:0', 'whitestar', nx=True))
+        self.assertEqual('starfury', self.r.get('ship:0'))
+
+    def test_delifeq(self):
+        self.r.set('ship:0', 'starfury')
+        self.assertEqual(0, self.r.delifeq('ship:0', 'whitestar'))
+        self.assertEqual(1, self.r.delifeq('ship:0', 'starfury'))
+        self.assertFalse(self.r.exists('ship:0'))
+
+    def test_wrong_type(self):
+        self.r.set('ship:0', 'starfury')
+        with self.assertRaises(ResponseError):
+            self.r.hgetall('ship:0')
+
+    def test_delete(self):
+        self.r.set('ship:0', 'starfury')
+        self.r.sadd('ships', 'ship:0')
+        self.assertEqual(2, self.r.delete('ship:0', 'ships', 'foo'))
+        self.assertEqual('none', self.r.type('ships'))
+
+    def test_pipeline(self):
+        replies = (self.r.pipeline().hset('ship:0', 'type', 'starfury')
+            .sadd('ships', 'ship:0').hgetall('ship:0').execute())
+        self.assertEqual([1, 1, {'type': 'starfury'}], replies)
+        with self.assertRaises(ResponseError):
+            self.r.pipeline().sadd('ship:0', 'foo').sadd('ships', 'ship:1'
+                ).execute()
+        self.assertTrue(self.r.sismember('ships', 'ship:1'))
+
+class MemoryEngineTest(TestCase, EngineTest):
+    def setUp(self):
+        self.r = MemoryEngine()
+
+class SQLiteEngineTest(TestCase, EngineTest):
+    def setUp(self):
+        self.r = SQLiteEngine(':memory:')
+
+    def test_persistence(self):
+        path = mkdtemp()
+        self.addCleanup(rmtree, path)
+        r = SQLiteEngine(os.path.join(path, 'wall.db'))
+        r.pipeline().hset('ship:0', 'type', 'starfury').sadd('ships', 'ship:0'
+            ).execute()
+        r = SQLiteEngine(os.path.join(path, 'wall.db'))
+        self.assertEqual({'type': 'starfury'}, r.hgetall('ship:0'))
+        self.assertTrue(r.sismember('ships', 'ship:0'))
+
+class AsyncEngineTest(AsyncTestCase):
+    def setUp(self):
+        super(AsyncEngineTest, self).setUp()
+        self.r = AsyncEngine(MemoryEngine())
+
+    @gen_test
+    def test_execute_command(self):
+        yield self.r.hmset('ship:0', {'type': 'starfury'})
+        self.assertEqual({'type': 'starfury'}, (yield self.r.hgetall('ship:0')))
+        with self.assertRaises(ResponseError):
+            yield self.r.sadd('ship:0', 'foo')
+
+    @gen_test
+    def test_pipeline(self):
+        replies = yield (self.r.pipeline().sadd('ships', 'ship:0')
+            .smembers('ships').execute())
+        self.assertEqual([1, set(['ship:0'])], replies)
+
+class ShardedRedisTest(TestCase):
+    def setUp(self):
+        self.shards = [[MemoryEngine(), MemoryEngine()], [MemoryEngine()]]
+        self.r = ShardedRedis(self.shards)
+        self.keys = ['ship:{}'.format(i) for i in xrange(100)]
+        pipe = self.r.pipeline()
+        for key in self.keys:
+            pipe.set(key, key)
+        pipe.execute()
+
+    def test_distribution(self):
+        counts = [len(s[0]._data) for s in self.shards]
+        self.assertEqual(len(self.keys), sum(counts))
+        self.assertTrue(all(counts))
+
+    def test_add_shard(self):
+        r = ShardedRedis(self.shards + [[MemoryEngine()]])
+        moved = [k for k in self.keys if r.shard(k) != self.r.shard(k)]
+        self.assertTrue(0 < len(moved) < len(self.keys) / 2)
+        self.assertTrue(all(r.shard(k) == 2 for k in moved))
+
+    def test_read_replica(self):
+        key = next(k for k in self.keys if self.r.shard(k) == 0)
+        # writes go to the primary, reads to the replica
+        self.assertIsNone(self.r.get(key))
+        self.shards[0][1].set(key, 'replica')
+        self.assertEqual('replica', self.r.get(key))
+        self.assertEqual(['replica'], self.r.pipeline().get(key).execute())
+        # pipelines with writes read from the primary
+        self.assertEqual([True, key],
+            self.r.pipeline().set('foo', 'bar').get(key).execute())
+
+    def test_mget(self):
+        keys = [k for k in self.keys if self.r.shard(k) == 1] + ['foo']
+        self.assertEqual(keys[:-1] + [None], self.r.mget(keys))
+
+    def test_delete(self):
+        self.assertEqual(len(self.keys), self.r.delete(*self.keys))
+        self.assertFalse(any(s[0]._data for s in self.shards))
+
+class AsyncShardedRedisTest(AsyncTestCase):
+    def setUp(self):
+        super(AsyncShardedRedisTest, self).setUp()
+        self.r = AsyncShardedRedis(
+            [[AsyncEngine(MemoryEngine())], [AsyncEngine(MemoryEngine())]])
+        self.keys = ['ship:{}'.format(i) for i in xrange(10)]
+
+    @gen_test
+    def test_pipeline(self):
+        pipe = self.r.pipeline()
+        for key in self.keys:
+            pipe.sadd('ships', key).set(key, key)
+        yield pipe.execute()
+        self.assertEqual(set(self.keys), (yield self.r.smembers('ships')))
+        self.assertEqual(self.keys[:2], (yield self.r.mget(self.keys[:2])))
+        self.assertEqual(2, (yield self.r.delete(*self.keys[:2])))
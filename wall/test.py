@@ -4,20 +4,34 @@
 from __future__ import (division, absolute_import, print_function,
     unicode_literals)
 
-from tornado.testing import AsyncTestCase
+import os
+import json
+from urllib import urlencode
+from tornado.testing import AsyncTestCase, gen_test, bind_unused_port
 from tornado.ioloop import IOLoop
+from tornado.gen import coroutine, Return
+from tornado.httpserver import HTTPServer
+from tornado.httpclient import HTTPRequest
+from tornado.websocket import websocket_connect
 from logging import getLogger, CRITICAL
 from redis import StrictRedis
 from wall import WallApp, Post, randstr
 
+test_storage = os.environ.get('WALL_TEST_STORAGE', 'memory')
+
 class TestCase(AsyncTestCase):
     """
     Extension API: Base for Wall unit tests. Takes care of setting / cleaning up
     the test environment and provides utilities for testing.
 
+    The storage engine used for testing is selected by the environment variable
+    `WALL_TEST_STORAGE` (`memory` by default, see the `storage` option). For
+    `redis`, the temporary Redis database `15` is used.
+
     Attributes:
 
-     * `db`: connection to temporary Redis database (`15`)
+     * `config`: configuration of the test application
+     * `db`: connection to the temporary database
      * `app`: Wall application. `TestPost` is available as registered post type.
     """
 
@@ -27,14 +41,61 @@ class TestCase(AsyncTestCase):
 
     def setUp(self):
         super(TestCase, self).setUp()
-        self.db = StrictRedis(db=15)
-        self.db.flushdb()
-        self.app = WallApp(config={'db': 15})
+        self.config = {'storage': test_storage, 'db': 15,
+                       'sqlite_path': ':memory:'}
+        if test_storage == 'redis':
+            StrictRedis(db=15).flushdb()
+        self.app = WallApp(config=self.config)
         self.app.add_post_type(TestPost)
+        self.db = self.app.db.r
+        self._port = None
+
+    def tearDown(self):
+        self.app.db.a.close()
+        super(TestCase, self).tearDown()
 
     def get_new_ioloop(self):
         return IOLoop.instance()
 
+    @coroutine
+    def connect(self, compression_options=None, subprotocols=[], **args):
+        """
+        Connect a WebSocket client to `app`, which is served on a free port on
+        first use. Query arguments for the socket may be given as `args`. If
+        `compression_options` are given, the client offers compression (see
+        `tornado.websocket.websocket_connect`). The client offers the list of
+        `subprotocols`.
+
+        The `session` message, which the client receives first, is skipped.
+        Returns a `Future` for the `WebSocketClientConnection`.
+        """
+        if not self._port:
+            sock, self._port = bind_unused_port()
+            server = HTTPServer(self.app)
+            server.add_sockets([sock])
+            self.addCleanup(server.stop)
+        headers = {}
+        if subprotocols:
+            headers['Sec-WebSocket-Protocol'] = ', '.join(subprotocols)
+        request = HTTPRequest('ws://localhost:{}/api/socket?{}'.format(
+            self._port, urlencode(args)), headers=headers)
+        ws = yield websocket_connect(request,
+            compression_options=compression_options)
+        self.addCleanup(ws.close)
+        yield ws.read_message()
+        raise Return(ws)
+
+    @coroutine
+    def receive(self, ws, count=1):
+        """
+        Receive `count` messages with the WebSocket client `ws` (see `connect`).
+        Returns a `Future` for the list of decoded messages.
+        """
+        messages = []
+        for i in xrange(count):
+            messages.append(json.loads((yield ws.read_message())))
+        raise Return(messages)
+
 class CommonPostTest(object):
     """
     Extension API: Mixin for `Post` tests. Provides common tests of the `Post`
@@ -55,11 +116,45 @@ class CommonPostTest(object):
         post = self.post_type.create(self.app, **self.create_args)
         self.assertTrue(post.id)
 
+    @gen_test
+    def test_create_async(self):
+        post = yield self.post_type.create_async(self.app, **self.create_args)
+        self.assertTrue(post.id)
+
+    def test_json(self):
+        post = self.post_type.create(self.app, **self.create_args)
+        data = post.json()
+        self.assertEqual(post.id, data['id'])
+        self.assertEqual(self.post_type.__name__, data['__type__'])
+        self.assertEqual(data, json.loads(post.json_str()))
+        self.assertIs(data, post.json())
+        post.title = 'Babylon 4'
+        self.assertEqual('Babylon 4', post.json()['title'])
+        self.assertEqual('Babylon 4', post.json('common')['title'])
+
+class TestClient(object):
+    """
+    Extension API: Client for testing, which records the messages sent to it
+    (e.g. via `WallApp.sendall` or `WallApp.publish`).
+
+    Attributes:
+
+     * `messages`: list of received messages.
+     * `topics`: topics the client is subscribed to.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.topics = set()
+
+    def send(self, msg):
+        self.messages.append(msg)
+
 class TestPost(Post):
     @classmethod
     def create(cls, app, **args):
         post = TestPost(app, 'test_post:' + randstr(), 'Test', None)
-        app.db.hmset(post.id, post.json())
+        app.db.store(post.id, post.json())
         return post
 
     def __init__(self, app, id, title, posted, **kwargs):
@@ -6,11 +6,20 @@ from __future__ import (division, absolute_import, print_function,
 
 import sys
 import json
+from calendar import timegm
+from datetime import datetime
 from urllib import urlencode
-from collections import Mapping
+from time import time, sleep
+from collections import Mapping, OrderedDict, deque
 from weakref import WeakValueDictionary
 from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+from tornado.tcpclient import TCPClient
+from tornado.iostream import StreamClosedError
+from tornado.concurrent import Future
+from tornado.gen import coroutine, multi_future, Return
 from redis import StrictRedis
+from redis.exceptions import ResponseError, ConnectionError, InvalidResponse
 
 class WebAPI(object):
     class Object(object):
@@ -85,6 +94,375 @@ class Event(object):
         self.target = None
         self.args = dict(args.items() + kwargs.items())
 
+class AsyncRedisCommands(object):
+    """
+    Redis commands of `AsyncRedis` and `AsyncPipeline`. The methods and their
+    replies are compatible to the ones of `StrictRedis`.
+    """
+
+    def execute_command(self, *args, **options):
+        raise NotImplementedError()
+
+    def get(self, name):
+        return self.execute_command('GET', name)
+
+    def mget(self, keys):
+        return self.execute_command('MGET', *keys)
+
+    def set(self, name, value, nx=False):
+        args = ['SET', name, value]
+        if nx:
+            args.append('NX')
+        return self.execute_command(*args, parse=_parse_ok)
+
+    def delete(self, *names):
+        return self.execute_command('DEL', *names)
+
+    def delifeq(self, name, value):
+        """
+        Delete the string `name` only if it holds `value`. Returns the number of
+        deleted keys.
+        """
+        return self.execute_command('EVAL', _DELIFEQ_SCRIPT, 1, name, value)
+
+    def eval(self, script, numkeys, *keys_and_args):
+        return self.execute_command('EVAL', script, numkeys, *keys_and_args)
+
+    def exists(self, name):
+        return self.execute_command('EXISTS', name, parse=bool)
+
+    def hget(self, name, key):
+        return self.execute_command('HGET', name, key)
+
+    def hgetall(self, name):
+        return self.execute_command('HGETALL', name, parse=_parse_pairs)
+
+    def hset(self, name, key, value):
+        return self.execute_command('HSET', name, key, value)
+
+    def hmset(self, name, mapping):
+        args = []
+        for item in mapping.items():
+            args.extend(item)
+        return self.execute_command('HMSET', name, *args, parse=_parse_ok)
+
+    def hdel(self, name, *keys):
+        return self.execute_command('HDEL', name, *keys)
+
+    def sadd(self, name, *values):
+        return self.execute_command('SADD', name, *values)
+
+    def srem(self, name, *values):
+        return self.execute_command('SREM', name, *values)
+
+    def sismember(self, name, value):
+        return self.execute_command('SISMEMBER', name, value, parse=bool)
+
+    def smembers(self, name):
+        return self.execute_command('SMEMBERS', name, parse=set)
+
+    def scard(self, name):
+        return self.execute_command('SCARD', name)
+
+    def zadd(self, name, *args):
+        return self.execute_command('ZADD', name, *args)
+
+    def zrem(self, name, *values):
+        return self.execute_command('ZREM', name, *values)
+
+    def zcard(self, name):
+        return self.execute_command('ZCARD', name)
+
+    def zrange(self, name, start, end):
+        return self.execute_command('ZRANGE', name, start, end)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None):
+        args = ['ZRANGEBYSCORE', name, min, max]
+        if start is not None and num is not None:
+            args.extend(['LIMIT', start, num])
+        return self.execute_command(*args)
+
+    def zrevrange(self, name, start, end):
+        return self.execute_command('ZREVRANGE', name, start, end)
+
+class AsyncRedis(AsyncRedisCommands):
+    """
+    Asynchronous Redis client, which runs on the Tornado IOLoop.
+
+    Commands are pipelined over a single connection, which is established on
+    first use. Every command returns a `Future` for its reply.
+
+    Attributes:
+
+     * `host`: host of the Redis server. Read-Only.
+     * `port`: port of the Redis server. Read-Only.
+     * `db`: Redis database index. Read-Only.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self._stream = None
+        self._connecting = False
+        self._outgoing = []
+        self._pending = deque()
+
+    def pipeline(self, transaction=True):
+        """
+        Return an `AsyncPipeline`, which buffers commands and sends them in a
+        single round trip. If `transaction` is set, the commands are executed
+        atomically (MULTI / EXEC).
+        """
+        return AsyncPipeline(self, transaction)
+
+    def execute_command(self, *args, **options):
+        return self._send([(args, options)])[-1]
+
+    def close(self):
+        if self._stream:
+            self._stream.close()
+
+    def _send(self, commands):
+        if not self._stream and not self._connecting:
+            self._connect()
+
+        futures = []
+        for args, options in commands:
+            future = None if options.get('ignore') else Future()
+            self._pending.append((future, options.get('parse')))
+            futures.append(future)
+
+        data = b''.join(_encode_command(args) for args, options in commands)
+        if self._connecting:
+            self._outgoing.append(data)
+        else:
+            self._stream.write(data)
+        return futures
+
+    def _connect(self):
+        self._connecting = True
+        self._outgoing.append(_encode_command(('SELECT', self.db)))
+        self._pending.append((None, None))
+        IOLoop.current().add_future(
+            TCPClient().connect(self.host, self.port), self._connected)
+
+    def _connected(self, future):
+        self._connecting = False
+        try:
+            self._stream = future.result()
+        except IOError as e:
+            self._fail(ConnectionError(str(e)))
+            return
+        self._stream.set_nodelay(True)
+        self._stream.write(b''.join(self._outgoing))
+        self._outgoing = []
+        self._read(self._stream)
+
+    @coroutine
+    def _read(self, stream):
+        reader = _ReplyReader()
+        try:
+            while True:
+                reader.feed((yield stream.read_bytes(65536, partial=True)))
+                for reply in reader.replies():
+                    self._reply(reply)
+        except StreamClosedError:
+            self._stream = None
+            self._fail(ConnectionError('connection_closed'))
+
+    def _reply(self, reply):
+        future, parse = self._pending.popleft()
+        if not future:
+            return
+        if isinstance(reply, ResponseError):
+            future.set_exception(reply)
+            return
+        try:
+            future.set_result(parse(reply) if parse else reply)
+        except ResponseError as e:
+            future.set_exception(e)
+
+    def _fail(self, error):
+        self._outgoing = []
+        while self._pending:
+            future, parse = self._pending.popleft()
+            if future:
+                future.set_exception(error)
+
+class AsyncPipeline(AsyncRedisCommands):
+    """
+    Buffer for commands of an `AsyncRedis` client, which are sent in a single
+    round trip by `execute`. Command methods return the pipeline itself.
+    """
+
+    def __init__(self, client, transaction=True):
+        self.client = client
+        self.transaction = transaction
+        self.commands = []
+
+    def execute_command(self, *args, **options):
+        self.commands.append((args, options))
+        return self
+
+    def execute(self):
+        """
+        Send all buffered commands. Returns a `Future` for the list of replies.
+        """
+        commands, self.commands = self.commands, []
+        if not commands:
+            future = Future()
+            future.set_result([])
+            return future
+
+        if not self.transaction:
+            return multi_future(self.client._send(commands))
+
+        parsers = [options.get('parse') for args, options in commands]
+        def parse(replies):
+            for reply in replies:
+                if isinstance(reply, ResponseError):
+                    raise reply
+            return [p(r) if p else r for p, r in zip(parsers, replies)]
+        commands = ([(('MULTI', ), {'ignore': True})] +
+            [(args, {'ignore': True}) for args, options in commands] +
+            [(('EXEC', ), {'parse': parse})])
+        return self.client._send(commands)[-1]
+
+class _ReplyReader(object):
+    # incremental parser of replies in the Redis protocol. The state of
+    # partially received replies is kept between chunks of data, so every byte
+    # is parsed only once, also for large replies.
+
+    def __init__(self):
+        self._buffer = b''
+        self._pos = 0
+        # received data not yet appended to the buffer and its size
+        self._chunks = []
+        self._size = 0
+        # arrays being parsed, each one a list of its items and the number of
+        # items still missing
+        self._arrays = []
+        # length of the bulk string being received
+        self._bulk = None
+
+    def feed(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+
+    def replies(self):
+        # return the list of replies completed by the data fed so far
+        replies = []
+        while True:
+            try:
+                value = self._parse()
+            except _IncompleteReply:
+                return replies
+            if value is _array:
+                continue
+            while self._arrays:
+                array = self._arrays[-1]
+                array[0].append(value)
+                array[1] -= 1
+                if array[1]:
+                    break
+                self._arrays.pop()
+                value = array[0]
+            else:
+                replies.append(value)
+
+    def _parse(self):
+        # parse the next value. Returns `_array` if an array is started.
+        if self._bulk is None:
+            line = self._line()
+            prefix = line[:1]
+            line = line[1:]
+            if prefix == b'+':
+                return line
+            elif prefix == b'-':
+                return ResponseError(line.decode('utf-8', 'replace'))
+            elif prefix == b':':
+                return int(line)
+            elif prefix == b'$':
+                length = int(line)
+                if length == -1:
+                    return None
+                self._bulk = length
+            elif prefix == b'*':
+                count = int(line)
+                if count == -1:
+                    return None
+                if count == 0:
+                    return []
+                self._arrays.append([[], count])
+                return _array
+            else:
+                raise InvalidResponse('prefix')
+
+        # the data is only joined once the whole bulk string is received
+        end = self._pos + self._bulk + 2
+        if len(self._buffer) + self._size < end:
+            raise _IncompleteReply()
+        if len(self._buffer) < end:
+            self._fill()
+            end = self._bulk + 2
+        value = self._buffer[self._pos:end - 2]
+        self._pos = end
+        self._bulk = None
+        return value
+
+    def _line(self):
+        end = self._buffer.find(b'\r\n', self._pos)
+        if end == -1:
+            if not self._chunks:
+                raise _IncompleteReply()
+            self._fill()
+            end = self._buffer.find(b'\r\n')
+            if end == -1:
+                raise _IncompleteReply()
+        line = self._buffer[self._pos:end]
+        self._pos = end + 2
+        return line
+
+    def _fill(self):
+        # append the received data to the rest of the buffer
+        self._buffer = self._buffer[self._pos:] + b''.join(self._chunks)
+        self._pos = 0
+        self._chunks = []
+        self._size = 0
+
+class _IncompleteReply(Exception):
+    pass
+
+_array = object()
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, float):
+        return repr(value)
+    return unicode(value).encode('utf-8')
+
+def _encode_command(args):
+    data = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        arg = _encode(arg)
+        data.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(data)
+
+_DELIFEQ_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def _parse_ok(reply):
+    return reply == b'OK'
+
+def _parse_pairs(reply):
+    return dict(zip(reply[::2], reply[1::2]))
+
 class ObjectRedis(object):
     """
     Extended Redis client, which additionally provides object-oriented
@@ -93,65 +471,355 @@ class ObjectRedis(object):
     Objects are represented as hashes in the Redis database. The translation
     from a hash to an object is carried out by a given `decode` function.
 
+    Alternatively, if `pack` and `unpack` functions are given, each hash is
+    stored packed into a single string value. Objects are loaded and stored
+    with `load`, `mload` and `store`, which take care of the encoding.
+
     When `caching` is enabled, objects loaded from the Redis database are cached
     and subsequently retrieved from the cache. An object stays in the cache as
     long as there is a reference to it and it is automatically removed when the
     Python interpreter destroys it. Thus, it is guaranteed that getting the same
     key multiple times will yield the identical object.
 
+    Additionally, the `cache_size` most recently used objects are kept alive by
+    the cache, even if there is no other reference to them. If `cache_ttl` is
+    set, these objects expire after the given number of seconds.
+
+    An object is removed from the cache when its hash is written via `hset`,
+    `hmset` or `delete`, or when a keyspace notification for it arrives (see
+    `subscribe_notifications`).
+
     Attributes:
 
-     * `r`: Underlying Redis client. Read-Only.
+     * `r`: Underlying Redis client or storage engine with a compatible
+       interface (see `wall.storage`). Read-Only.
      * `decode`: function, which decodes an object from a Redis hash. It is
        called with the hash (a `dict`) as single argument. Read-Only.
      * `caching`: switch to enable / disable object caching.
+     * `cache_size`: number of recently used objects kept alive by the cache.
+       `0` disables this cache tier.
+     * `cache_ttl`: time in seconds after which a kept alive object expires.
+       `0` means they never expire.
+     * `stats`: cache statistics, a `dict` with the number of cache `hits`,
+       `misses` and `evictions`.
+     * `a`: `AsyncRedis` client for the same database, used by the asynchronous
+       operations (`oget_async` and `omget_async`). Read-Only.
+     * `pack`: function, which packs a hash into a string. It is called with
+       the key and the hash as arguments. `None` if hashes are stored as Redis
+       hashes. Read-Only.
+     * `unpack`: function, which unpacks a hash from a string. It is called
+       with the key and the string as arguments. Read-Only.
     """
     # TODO: add oset and omset
 
-    def __init__(self, r, decode, caching=True):
+    def __init__(self, r, decode, caching=True, cache_size=0, cache_ttl=0,
+                 a=None, pack=None, unpack=None):
         self.r = r
+        self.a = a
         self.decode = decode
+        self.pack = pack
+        self.unpack = unpack
         self.caching = caching
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
         self._cache = WeakValueDictionary()
+        self._lru = OrderedDict()
+        self._pubsub = None
 
     def oget(self, key):
         """
         Get the object for `key`.
         """
-        object = self._cache.get(key) if self.caching else None
+        object = self._cache_get(key)
         if not object:
-            hash = self.hgetall(key)
+            hash = self.load(key)
             if hash:
                 object = self.decode(hash)
-                if self.caching:
-                    self._cache[key] = object
+                self._cache_put(key, object)
         return object
 
     def omget(self, keys):
         """
         Get the objects for all specified `keys`.
+
+        All objects missing from the cache are fetched atomically in a single
+        round trip.
+        """
+        keys = list(keys)
+        objects, missing = self._lookup(keys)
+        if missing:
+            pipe = self.r.pipeline()
+            for key in missing:
+                self._queue_load(pipe, key)
+            self._load(objects, missing, pipe.execute())
+        return [objects.get(k) for k in keys]
+
+    @coroutine
+    def oget_async(self, key):
         """
-        # TODO: make atomic
-        return [self.oget(k) for k in keys]
+        Asynchronous variant of `oget`. Returns a `Future` for the object.
+        """
+        objects = yield self.omget_async([key])
+        raise Return(objects[0])
+
+    @coroutine
+    def omget_async(self, keys):
+        """
+        Asynchronous variant of `omget`. Returns a `Future` for the objects.
+        """
+        keys = list(keys)
+        objects, missing = self._lookup(keys)
+        if missing:
+            pipe = self.a.pipeline()
+            for key in missing:
+                self._queue_load(pipe, key)
+            self._load(objects, missing, (yield pipe.execute()))
+        raise Return([objects.get(k) for k in keys])
+
+    def load(self, key):
+        """
+        Load the hash for `key`. An empty hash is returned if there is none.
+        """
+        return self.mload([key])[0]
+
+    def mload(self, keys):
+        """
+        Load the hashes for all specified `keys` in a single round trip.
+        """
+        keys = list(keys)
+        pipe = self.r.pipeline(transaction=False)
+        for key in keys:
+            self._queue_load(pipe, key)
+        return [self._loaded(k, r) for k, r in zip(keys, pipe.execute())]
+
+    @coroutine
+    def mload_async(self, keys):
+        """
+        Asynchronous variant of `mload`. Returns a `Future` for the hashes.
+        """
+        keys = list(keys)
+        pipe = self.a.pipeline(transaction=False)
+        for key in keys:
+            self._queue_load(pipe, key)
+        replies = yield pipe.execute()
+        raise Return([self._loaded(k, r) for k, r in zip(keys, replies)])
+
+    def store(self, key, hash, pipe=None):
+        """
+        Store the `hash` for `key`, replacing the existing one. If a pipeline
+        `pipe` (of `r` or `a`) is given, the command is queued on it.
+        """
+        self.invalidate(key)
+        queue = self.r.pipeline() if pipe is None else pipe
+        if self.pack:
+            queue.set(key, self.pack(key, hash))
+        else:
+            queue.delete(key)
+            queue.hmset(key, hash)
+        if pipe is None:
+            queue.execute()
+
+    def hset(self, name, key, value):
+        self.invalidate(name)
+        return self.r.hset(name, key, value)
+
+    def hmset(self, name, mapping):
+        self.invalidate(name)
+        return self.r.hmset(name, mapping)
+
+    def delete(self, *names):
+        for name in names:
+            self.invalidate(name)
+        return self.r.delete(*names)
+
+    def invalidate(self, key):
+        """
+        Remove the object for `key` from the cache.
+        """
+        self._cache.pop(key, None)
+        self._lru.pop(key, None)
+
+    def subscribe_notifications(self):
+        """
+        Subscribe to keyspace notifications, so that objects modified by other
+        Redis clients are removed from the cache. Received notifications are
+        handled by `process_notifications`.
+
+        Keyspace notifications for generic and hash commands must be enabled on
+        the Redis server (i.e. `notify-keyspace-events` includes `Kgh`).
+        """
+        db = self.r.connection_pool.connection_kwargs.get('db', 0)
+        self._pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.psubscribe('__keyspace@{}__:*'.format(db))
+
+    def process_notifications(self):
+        """
+        Handle all pending keyspace notifications. Does not block.
+        """
+        while True:
+            message = self._pubsub.get_message()
+            if not message:
+                break
+            if message['type'] == 'pmessage':
+                self.invalidate(message['channel'].split(':', 1)[1])
+
+    def _lookup(self, keys):
+        # get the cached objects for `keys`. Returns a dictionary of the cached
+        # objects and a list of the (unique) missing keys.
+        objects = {}
+        missing = []
+        for key in keys:
+            if key in objects or key in missing:
+                continue
+            object = self._cache_get(key)
+            if object:
+                objects[key] = object
+            else:
+                missing.append(key)
+        return objects, missing
+
+    def _queue_load(self, pipe, key):
+        if self.pack:
+            pipe.get(key)
+        else:
+            pipe.hgetall(key)
+
+    def _loaded(self, key, reply):
+        # convert the `reply` of a load command for `key` to a hash
+        if self.pack:
+            return self.unpack(key, reply) if reply else {}
+        return reply
+
+    def _load(self, objects, keys, replies):
+        # decode the `replies` of the load commands for `keys` into `objects`
+        for key, reply in zip(keys, replies):
+            hash = self._loaded(key, reply)
+            if hash:
+                object = self.decode(hash)
+                objects[key] = object
+                self._cache_put(key, object)
+
+    def _cache_get(self, key):
+        if not self.caching:
+            return None
+
+        entry = self._lru.pop(key, None)
+        if entry:
+            if entry[1] and time() >= entry[1]:
+                self._cache.pop(key, None)
+                self.stats['evictions'] += 1
+            else:
+                self._lru[key] = entry
+
+        object = self._cache.get(key)
+        self.stats['hits' if object else 'misses'] += 1
+        return object
+
+    def _cache_put(self, key, object):
+        if not self.caching:
+            return
+
+        self._cache[key] = object
+        if self.cache_size:
+            expires = time() + self.cache_ttl if self.cache_ttl else None
+            self._lru.pop(key, None)
+            self._lru[key] = (object, expires)
+            while len(self._lru) > self.cache_size:
+                self._lru.popitem(last=False)
+                self.stats['evictions'] += 1
 
     def __getattr__(self, name):
         return getattr(self.r, name)
 
 class RedisContainer(Mapping):
-    def __init__(self, r, set_key):
+    """
+    Mapping of the objects whose keys are members of the Redis set `set_key`.
+
+    Iteration (`__iter__`, `iterkeys`, `itervalues` and `iteritems`) is
+    incremental: keys are scanned (SSCAN) and objects are loaded in batches of
+    about `batch_size`, so that large sets neither block the Redis server nor are
+    held in memory at once. As with SSCAN, a key may be returned more than once
+    and keys modified during iteration may or may not be returned.
+
+    Attributes:
+
+     * `r`: `ObjectRedis` client. Read-Only.
+     * `set_key`: key of the set. Read-Only.
+     * `batch_size`: default number of keys fetched per round trip during
+       iteration.
+    """
+
+    def __init__(self, r, set_key, batch_size=100):
         self.r = r
         self.set_key = set_key
+        self.batch_size = batch_size
 
     def keys(self):
         return list(self.r.smembers(self.set_key))
 
+    def values(self):
+        return self.r.omget(self.keys())
+
+    def items(self):
+        keys = self.keys()
+        return zip(keys, self.r.omget(keys))
+
+    def iterkeys(self, batch_size=None):
+        return self.r.sscan_iter(self.set_key,
+            count=batch_size or self.batch_size)
+
+    def itervalues(self, batch_size=None):
+        for key, object in self.iteritems(batch_size):
+            yield object
+
+    def iteritems(self, batch_size=None):
+        batch_size = batch_size or self.batch_size
+        batch = []
+        for key in self.iterkeys(batch_size):
+            batch.append(key)
+            if len(batch) == batch_size:
+                for item in zip(batch, self.r.omget(batch)):
+                    yield item
+                batch = []
+        if batch:
+            for item in zip(batch, self.r.omget(batch)):
+                yield item
+
+    @coroutine
+    def get_async(self, key):
+        """
+        Asynchronous variant of `__getitem__`. Returns a `Future` for the object.
+        """
+        object = self.r._cache_get(key)
+        pipe = self.r.a.pipeline()
+        pipe.sismember(self.set_key, key)
+        if not object:
+            self.r._queue_load(pipe, key)
+        raise Return(self._get(key, object, (yield pipe.execute())))
+
     def __getitem__(self, key):
-        if key not in self:
-            raise KeyError()
-        return self.r.oget(key)
+        # check membership and, on a cache miss, fetch the object in a single
+        # round trip
+        object = self.r._cache_get(key)
+        pipe = self.r.pipeline()
+        pipe.sismember(self.set_key, key)
+        if not object:
+            self.r._queue_load(pipe, key)
+        return self._get(key, object, pipe.execute())
+
+    def _get(self, key, object, result):
+        if not result[0]:
+            raise KeyError(key)
+        if not object:
+            hash = self.r._loaded(key, result[1])
+            if hash:
+                object = self.r.decode(hash)
+                self.r._cache_put(key, object)
+        return object
 
     def __iter__(self):
-        return iter(self.keys())
+        return self.iterkeys()
 
     def __len__(self):
         return self.r.scard(self.set_key)
@@ -194,9 +862,36 @@ def truncate(s, length=64, ellipsis='\u2026'):
     else:
         return s
 
+def timestamp(time):
+    """
+    Return the POSIX timestamp (in seconds) of the naive UTC `datetime` `time`.
+    """
+    return timegm(time.utctimetuple()) + time.microsecond / 1000000
+
+def parse_isotime(string):
+    """
+    Parse an ISO 8601 time `string`, as produced by `datetime.isoformat()`, into
+    a `datetime`.
+    """
+    try:
+        return datetime.strptime(string, '%Y-%m-%dT%H:%M:%S.%f')
+    except ValueError:
+        return datetime.strptime(string, '%Y-%m-%dT%H:%M:%S')
+
 # ==== Tests ====
 
+import os
 from unittest import TestCase
+from tornado.testing import AsyncTestCase, gen_test
+
+test_storage = os.environ.get('WALL_TEST_STORAGE', 'memory')
+
+def open_test_engine():
+    # imported here, because wall.storage depends on this module
+    from wall.storage import open_engine
+    r, a = open_engine(test_storage, db=15, path=':memory:')
+    r.flushdb()
+    return r, a
 
 class EventTargetTest(TestCase):
     class Ship(EventTarget):
@@ -227,6 +922,85 @@ class EventTargetTest(TestCase):
     def fired(self, event):
         self.dispatched_event = event
 
+class TimeTest(TestCase):
+    def test_timestamp(self):
+        self.assertEqual(timestamp(datetime(1970, 1, 2, 0, 0, 0, 500000)),
+            86400.5)
+
+    def test_parse_isotime(self):
+        time = datetime(2258, 1, 1, 12, 30, 0, 250)
+        self.assertEqual(parse_isotime(time.isoformat()), time)
+        time = time.replace(microsecond=0)
+        self.assertEqual(parse_isotime(time.isoformat()), time)
+
+class ReplyReaderTest(TestCase):
+    def test_replies(self):
+        data = (b'+OK\r\n:42\r\n$-1\r\n*3\r\n$8\r\nstarfury\r\n*0\r\n'
+                b'*2\r\n-ERR foo\r\n$0\r\n\r\n')
+        expected = [b'OK', 42, None, [b'starfury', [], [b'ERR foo', b'']]]
+        for size in [1, 3, len(data)]:
+            reader = _ReplyReader()
+            replies = []
+            for i in xrange(0, len(data), size):
+                reader.feed(data[i:i + size])
+                replies.extend(reader.replies())
+            replies[3][2][0] = unicode(replies[3][2][0])
+            self.assertEqual(expected, replies)
+
+class AsyncRedisTest(AsyncTestCase):
+    def setUp(self):
+        if test_storage != 'redis':
+            self.skipTest('requires storage = redis')
+        super(AsyncRedisTest, self).setUp()
+        StrictRedis(db=15).flushdb()
+        self.r = AsyncRedis(db=15)
+
+    def tearDown(self):
+        self.r.close()
+        super(AsyncRedisTest, self).tearDown()
+
+    @gen_test
+    def test_execute_command(self):
+        ship = {'id': 'ship:0', 'type': 'starfury'}
+        yield self.r.hmset('ship:0', ship)
+        self.assertEqual(ship, (yield self.r.hgetall('ship:0')))
+        self.assertEqual(ship, StrictRedis(db=15).hgetall('ship:0'))
+
+    @gen_test
+    def test_execute_command_error(self):
+        yield self.r.set('ship:0', 'starfury')
+        with self.assertRaises(ResponseError):
+            yield self.r.hget('ship:0', 'type')
+
+    @gen_test
+    def test_set_nx_delifeq(self):
+        self.assertTrue((yield self.r.set('ship:0', 'starfury', nx=True)))
+        self.assertFalse((yield self.r.set('ship:0', 'whitestar', nx=True)))
+        self.assertEqual(0, (yield self.r.delifeq('ship:0', 'whitestar')))
+        self.assertEqual(1, (yield self.r.delifeq('ship:0', 'starfury')))
+        self.assertFalse((yield self.r.exists('ship:0')))
+
+    @gen_test
+    def test_eval(self):
+        self.assertEqual([b'ship:0', b'starfury'], (yield self.r.eval(
+            "return {KEYS[1], ARGV[1]}", 1, 'ship:0', 'starfury')))
+
+    @gen_test
+    def test_pipeline(self):
+        replies = yield (self.r.pipeline().sadd('ships', 'ship:0')
+            .sismember('ships', 'ship:0').smembers('ships').execute())
+        self.assertEqual([1, True, set(['ship:0'])], replies)
+
+    @gen_test
+    def test_pipeline_error(self):
+        yield self.r.set('ship:0', 'starfury')
+        with self.assertRaises(ResponseError):
+            yield (self.r.pipeline().sadd('ships', 'ship:1')
+                .hget('ship:0', 'type').execute())
+        self.assertTrue((yield self.r.sismember('ships', 'ship:1')))
+        with self.assertRaises(ResponseError):
+            yield self.r.pipeline().execute_command('FOO').execute()
+
 class ObjectRedisTest(TestCase):
     class Ship(object):
         def __init__(self, id, type):
@@ -238,8 +1012,7 @@ class ObjectRedisTest(TestCase):
         return ObjectRedisTest.Ship(**hash)
 
     def setUp(self):
-        self.r = ObjectRedis(StrictRedis(db=15), self.decode)
-        self.r.flushdb()
+        self.r = ObjectRedis(open_test_engine()[0], self.decode)
 
         self.objects = {
             'ship:0': ObjectRedisTest.Ship('ship:0', 'starfury'),
@@ -274,10 +1047,96 @@ class ObjectRedisTest(TestCase):
         for a, b in zip(self.objects.values(), ships):
             self.assertEqual(vars(a), vars(b))
 
+    def test_omget_cached(self):
+        ship = self.r.oget('ship:0')
+        ships = self.r.omget(['ship:0', 'ship:1', 'ship:0'])
+        self.assertEqual(id(ship), id(ships[0]))
+        self.assertEqual(id(ship), id(ships[2]))
+        self.assertEqual(id(ships[1]), id(self.r.oget('ship:1')))
+
+    def test_omget_nonexistent(self):
+        self.assertEqual([None], self.r.omget(['foo']))
+
+    def test_cache_size(self):
+        self.r.cache_size = 1
+        uid = id(self.r.oget('ship:0'))
+        self.assertEqual(uid, id(self.r.oget('ship:0')))
+        self.r.oget('ship:1')
+        self.assertEqual(self.r.stats,
+            {'hits': 1, 'misses': 2, 'evictions': 1})
+
+    def test_cache_ttl(self):
+        self.r.cache_size = 2
+        self.r.cache_ttl = 0.01
+        self.r.oget('ship:0')
+        sleep(0.02)
+        self.r.oget('ship:0')
+        self.assertEqual(self.r.stats,
+            {'hits': 0, 'misses': 2, 'evictions': 1})
+
+    def test_hset_invalidates(self):
+        ship = self.r.oget('ship:0')
+        self.r.hset('ship:0', 'type', 'whitestar')
+        same = self.r.oget('ship:0')
+        self.assertNotEqual(id(ship), id(same))
+        self.assertEqual(same.type, 'whitestar')
+
+    def test_store_pipe(self):
+        pipe = self.r.pipeline()
+        self.r.store('ship:2', {'id': 'ship:2', 'type': 'whitestar'}, pipe)
+        self.assertFalse(self.r.exists('ship:2'))
+        pipe.execute()
+        self.assertEqual('whitestar', self.r.oget('ship:2').type)
+
+    def test_process_notifications(self):
+        if test_storage != 'redis':
+            self.skipTest('requires storage = redis')
+        self.r.config_set('notify-keyspace-events', 'Kgh')
+        self.r.subscribe_notifications()
+        ship = self.r.oget('ship:0')
+        StrictRedis(db=15).hset('ship:0', 'type', 'whitestar')
+        for i in xrange(100):
+            self.r.process_notifications()
+            if 'ship:0' not in self.r._cache:
+                break
+            sleep(0.01)
+        self.assertEqual(self.r.oget('ship:0').type, 'whitestar')
+
+class ObjectRedisAsyncTest(AsyncTestCase):
+    def setUp(self):
+        super(ObjectRedisAsyncTest, self).setUp()
+        r, a = open_test_engine()
+        self.r = ObjectRedis(r, ObjectRedisTest.decode, a=a)
+        self.r.hmset('ship:0', {'id': 'ship:0', 'type': 'starfury'})
+        self.r.sadd('ships', 'ship:0')
+        self.ships = RedisContainer(self.r, 'ships')
+
+    def tearDown(self):
+        self.r.a.close()
+        super(ObjectRedisAsyncTest, self).tearDown()
+
+    @gen_test
+    def test_oget_async(self):
+        ship = yield self.r.oget_async('ship:0')
+        self.assertEqual('starfury', ship.type)
+        self.assertEqual(id(ship), id(self.r.oget('ship:0')))
+
+    @gen_test
+    def test_omget_async(self):
+        ships = yield self.r.omget_async(['ship:0', 'foo'])
+        self.assertEqual('starfury', ships[0].type)
+        self.assertIsNone(ships[1])
+
+    @gen_test
+    def test_container_get_async(self):
+        ship = yield self.ships.get_async('ship:0')
+        self.assertEqual('starfury', ship.type)
+        with self.assertRaises(KeyError):
+            yield self.ships.get_async('foo')
+
 class RedisContainerTest(TestCase):
     def setUp(self):
-        self.r = ObjectRedis(StrictRedis(db=15), ObjectRedisTest.decode)
-        self.r.flushdb()
+        self.r = ObjectRedis(open_test_engine()[0], ObjectRedisTest.decode)
 
         self.objects = {
             'ship:0': ObjectRedisTest.Ship('ship:0', 'starfury'),
@@ -296,6 +1155,33 @@ class RedisContainerTest(TestCase):
         self.assertEqual(vars(self.objects['ship:0']),
             vars(self.ships['ship:0']))
 
+    def test_values(self):
+        ships = sorted(self.ships.values(), key=lambda s: s.id)
+        self.assertEqual([vars(self.objects[k]) for k in sorted(self.objects)],
+            [vars(s) for s in ships])
+
+    def test_items(self):
+        for key, ship in self.ships.items():
+            self.assertEqual(vars(self.objects[key]), vars(ship))
+
+    def test_getitem_nonexistent(self):
+        with self.assertRaises(KeyError):
+            self.ships['foo']
+
+    def test_iterkeys(self):
+        self.assertEqual(set(self.objects), set(self.ships.iterkeys(1)))
+
+    def test_itervalues(self):
+        ships = sorted(self.ships.itervalues(1), key=lambda s: s.id)
+        self.assertEqual([vars(self.objects[k]) for k in sorted(self.objects)],
+            [vars(s) for s in ships])
+
+    def test_iteritems(self):
+        items = list(self.ships.iteritems(1))
+        self.assertEqual(len(self.objects), len(items))
+        for key, ship in items:
+            self.assertEqual(vars(self.objects[key]), vars(ship))
+
     def test_len(self):
         self.assertEqual(len(self.objects), len(self.ships))
 